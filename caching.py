@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
+import time
+import zlib
+import random
+import cPickle
+import hashlib
+import logging
 import threading
+from collections import OrderedDict
 from google.appengine.api import memcache
 
 
@@ -7,15 +14,52 @@ c = memcache.Client()
 
 
 prc = None
-max_recent_users = 20
+
+# title sets of old generations are left to expire
+titles_exp_sec = 60 * 60 * 24
+title_index_cas_retries = 5
+
+# in-process tier: shared by all requests served by this instance
+local_max_size = 1000
+local_ttl = 60 * 10
+# other instances notice an invalidation within this many seconds
+generation_ttl = 5
+# wikiquery results are kept until an index term or page they depend on changes
+wikiquery_exp_sec = 60 * 60 * 24
+# html of markdown blocks is left to expire once no page is made of them
+markdown_exp_sec = 60 * 60 * 24 * 7
+# previews are requested again and again only while a page is being edited
+preview_exp_sec = 60 * 10
+
+# None is stored as a sentinel for a short time, so that legitimately empty
+# values are not looked up again and again
+negative_exp_sec = 60
+_none = '\0none'
+_missing = object()
+
+# only one request recomputes an expensive value at a time. others serve
+# the previous value, kept under a stale key, or wait for the new one
+lease_sec = 10
+lease_wait_sec = 3
+lease_poll_sec = 0.1
+stale_exp_sec = 60 * 60 * 24
+
+# larger values are compressed, and split into chunks if still too large
+compress_threshold = 32 * 1024
+chunk_size = 900 * 1024
+_pickled = '\0pickle\0'
+_zlib = '\0zlib\0'
+_chunks = '\0chunks\0'
+
+# hit and miss counts, shared by the threads of an instance
+stats = {}
+_stats_lock = threading.Lock()
 
 
 class PerRequestCache(threading.local):
-    def get(self, key):
-        if key in self.__dict__:
-            return self.__dict__[key]
-        else:
-            return None
+    """Values seen by the current request. None means the key is known to be empty."""
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
 
     def set(self, key, value):
         self.__dict__[key] = value
@@ -24,6 +68,45 @@ class PerRequestCache(threading.local):
         self.__dict__.clear()
 
 
+class LocalCache(object):
+    """Bounded, thread-safe LRU cache whose entries expire after a TTL"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def flush_all(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local = LocalCache(local_max_size, local_ttl)
+
+
 def create_prc():
     global prc
     prc = PerRequestCache()
@@ -35,168 +118,278 @@ if prc is None:
 
 def flush_all():
     prc.flush_all()
+    local.flush_all()
     c.flush_all()
 
 
-def add_recent_email(email):
-    emails = get_recent_emails()
-    if len(emails) > 0 and emails[-1] == email:
-        return
-    if email in emails:
-        emails.remove(email)
-    emails.append(email)
-    value = emails[-max_recent_users:]
-    _set_cache('view\trecentemails', value)
+def get_stats():
+    """Returns hit and miss counts of each tier: prc, local and memcache, and number of uncacheable values"""
+    with _stats_lock:
+        return dict((tier, dict(counts)) for tier, counts in stats.items())
 
 
-def get_recent_emails():
-    key = 'view\trecentemails'
-    try:
-        emails = c.get(key)
-        if emails is None:
-            c.flush_all()
-            emails = []
-        return emails
-    except:
-        return []
+def reset_stats():
+    with _stats_lock:
+        stats.clear()
+
+
+def _count(tier, hit):
+    with _stats_lock:
+        counts = stats.setdefault(tier, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+
+def _count_uncacheable(key, reason):
+    logging.warning(u'Cannot cache %s: %s' % (key, reason))
+    with _stats_lock:
+        counts = stats.setdefault('uncacheable', {'values': 0})
+        counts['values'] += 1
 
 
 def set_titles(email, content):
-    try:
-        add_recent_email(email)
-        c.set('model\ttitles\t%s' % email, content)
-    except:
-        pass
+    _set_titles_value('title_sets', 'model\ttitles', email, content)
 
 
 def get_titles(email):
-    try:
-        return c.get('model\ttitles\t%s' % email)
-    except:
-        pass
+    return _get_titles_value('title_sets', 'model\ttitles', email)
 
 
-def del_titles():
-    try:
-        emails = get_recent_emails()
-        keys = ['model\ttitles\t%s' % email
-                for email in emails + ['None']]
-        c.delete_multi(keys)
-    except:
-        pass
+def set_title_index(content):
+    _set_titles_value('titles', 'model\ttitle_index', u'', content)
+    _bump_generation('title_sets')
+
+
+def get_title_index():
+    return _get_titles_value('titles', 'model\ttitle_index', u'')
+
+
+def compute_title_index(compute):
+    """Returns compute(), computed by a single request at a time, and caches it.
+
+    The index is stored under the generation it is computed in, and never over
+    an index cached meanwhile, which may have been updated in place since.
+    """
+    generation = _get_generation('titles')
+    if generation is None:
+        return compute()
+    key = _titles_key('model\ttitle_index', generation, u'')
+
+    def store(value):
+        if _store(key, value, titles_exp_sec, add=True):
+            _set_local('title_sets', key, value)
+    return _compute_once(key, None, compute, store)
+
+
+def update_title_index(func):
+    """Applies func to the cached title index in place.
 
+    Title sets derived from the index are invalidated. If the index cannot
+    be updated, every title cache is dropped instead.
+    """
+    generation = _get_generation('titles')
+    if generation is not None:
+        key = _titles_key('model\ttitle_index', generation, u'')
+        try:
+            for _ in range(title_index_cas_retries):
+                packed = c.gets(key)
+                if packed is None:
+                    # not cached. it'll be built from scratch on next read, and
+                    # one being built meanwhile is left under an old generation
+                    del_titles()
+                    return True
+                index = _unpack(key, packed)
+                if not isinstance(index, dict):
+                    break
+                func(index)
+                packed = _pack(key, index, titles_exp_sec)
+                if packed is None:
+                    break
+                if c.cas(key, packed, titles_exp_sec):
+                    _bump_generation('title_sets')
+                    return True
+        except:
+            pass
 
-def set_schema_set(value):
-    _set_cache('schema_set', value)
+    del_titles()
+    return False
 
 
-def set_schema(key, value):
-    _set_cache('schema\t%s' % key, value)
+def del_titles():
+    _bump_generation('titles')
+    _bump_generation('title_sets')
 
 
-def set_schema_itemtypes(value):
-    _set_cache('schema\titemtypes', value)
+def compute_titles(email, compute):
+    """Returns compute(), computed by a single request at a time, and caches it.
 
+    Stale title sets are never served because they decide what a user may read.
+    The set is stored under the generation it is computed in, so a set computed
+    while the generation moves is never read.
+    """
+    generation = _get_generation('title_sets')
+    if generation is None:
+        return compute()
+    key = _titles_key('model\ttitles', generation, email)
+    return _compute_once(key, None, compute, lambda value: _store_titles(key, value, generation))
 
-def set_schema_selectable_itemtypes(value):
-    _set_cache('schema\tselectable_itemtypes', value)
 
+def _titles_key(prefix, generation, name):
+    return u'%s\t%d\t%s' % (prefix, generation, name)
 
-def set_schema_property(prop_name, prop):
-    _set_cache('schema\tprop\t%s' % prop_name, prop)
 
+def _set_titles_value(namespace, prefix, name, content):
+    generation = _get_generation(namespace)
+    if generation is None:
+        return
+    _store_titles(_titles_key(prefix, generation, name), content)
 
-def set_schema_datatype(type_name, prop):
-    _set_cache('schema\tdatatype\t%s' % type_name, prop)
 
-def set_cardinalities(key, data):
+def _store_titles(key, content, generation=None):
+    # local copies are stamped with generation of title_sets, current one by default
     try:
-        return c.set('schema\tcardinalities\t%s' % key, data)
+        _store(key, content, titles_exp_sec)
+        _set_local('title_sets', key, content, generation)
     except:
         pass
 
-def set_config(value):
-    _set_cache('model\tconfig', value)
 
+def _get_titles_value(namespace, prefix, name):
+    generation = _get_generation(namespace)
+    if generation is None:
+        return None
+    key = _titles_key(prefix, generation, name)
 
-def set_rendered_body(title, value):
-    if not value:
-        return
+    # local copies are stamped with title_sets, which is bumped on every change
+    value = _get_local('title_sets', key)
+    if value is not None:
+        return value
 
-    _set_cache('model\trendered_body\t%s' % title, value)
+    value = _load(key)
+    _count('memcache', value is not None)
+    if value is not None:
+        _set_local('title_sets', key, value)
+    return value
 
 
-def set_wikiquery(q, email, value):
-    # adaptive expiration time
-    exp_sec = 60
-    if type(value) == list:
-        if len(value) < 2:
-            exp_sec = 60
-        elif len(value) < 10:
-            exp_sec = 60 * 5
-        elif len(value) < 100:
-            exp_sec = 60 * 60
-        elif len(value) < 500:
-            exp_sec = 60 * 60 * 24
+def prefetch_page(title):
+    prefetch_pages([title])
 
-    _set_cache('model\twikiquery\t%s\t%s' % (q, email), value, exp_sec)
 
+def prefetch_pages(titles):
+    """Fills per-request cache with cached values of pages in a single memcache round trip"""
+    _prefetch([fmt % title for title in titles for fmt in _page_key_formats])
 
-def set_data(title, value):
-    _set_cache('model\tdata\t%s' % title, value)
 
+def prefetch_markdown_htmls(digests):
+    """Fills per-request cache with cached html of markdown texts in a single memcache round trip"""
+    _prefetch(['model\tmarkdown\t%s' % digest for digest in digests])
 
-def set_metadata(title, value):
-    _set_cache('model\tmetadata\t%s' % title, value)
 
+def compute_rendered_body(title, compute):
+    """Returns compute(), computed by a single request at a time, and caches it"""
+    key = 'model\trendered_body\t%s' % title
+    return _compute_once(key, _stale_key(key), compute, lambda value: set_rendered_body(title, value))
+
+
+def compute_wikiquery(q, email, compute):
+    """Returns results of compute(), computed by a single request at a time, and caches them.
+
+    compute should return the results and a list of generations they depend on,
+    each taken by get_wikiquery_generations before reading what it covers.
+    """
+    def compute_entry():
+        results, generations = compute()
+        return _wikiquery_entry(results, generations)
+
+    key = 'model\twikiquery\t%s\t%s' % (q, email)
+    entry = _compute_once(key, _stale_key(key), compute_entry, lambda entry: _set_wikiquery_entry(key, entry))
+    return entry['results']
 
-def set_hashbangs(title, value):
-    _set_cache('model\thashbangs\t%s' % title, value)
 
+def get_wikiquery_generations(terms=(), titles=(), namespaces=()):
+    """Returns current generations of index terms, page data and namespaces, or None on failure"""
+    names = [_term_namespace(name, value) for name, value in terms]
+    names += [_page_namespace(title) for title in titles]
+    names += namespaces
+    return _get_generations(names)
 
 
+def del_wikiquery_dependencies(terms=(), titles=()):
+    """Invalidates wikiquery results depending on given index terms and data of given pages"""
+    names = [_term_namespace(name, value) for name, value in terms]
+    names += [_page_namespace(title) for title in titles]
+    if len(names) == 0:
+        return
+    try:
+        c.offset_multi(dict(('generation\t%s' % name, 1) for name in names),
+                       initial_value=int(time.time() * 1000))
+    except:
+        pass
 
-def get_schema_set():
-    return _get_cache('schema_set')
 
+def set_config(value):
+    _set_cache('model\tconfig', value, namespace='config')
 
-def get_schema(key):
-    return _get_cache('schema\t%s' % key)
 
+def set_rendered_body(title, value):
+    key = 'model\trendered_body\t%s' % title
+    _set_cache(key, value, stale_key=_stale_key(key))
 
-def get_schema_itemtypes():
-    return _get_cache('schema\titemtypes')
 
+def set_markdown_html(digest, value):
+    _set_cache('model\tmarkdown\t%s' % digest, value, exp_sec=markdown_exp_sec)
 
-def get_schema_selectable_itemtypes():
-    return _get_cache('schema\tselectable_itemtypes')
 
+def set_markdown_htmls(htmls):
+    """Caches html of markdown texts by their digests in a single memcache round trip"""
+    _set_cache_multi(dict(('model\tmarkdown\t%s' % digest, html) for digest, html in htmls.items()),
+                     exp_sec=markdown_exp_sec)
 
-def get_schema_property(prop_name):
-    return _get_cache('schema\tprop\t%s' % prop_name)
 
+def set_preview(title, stamp, value):
+    _set_cache('model\tpreview\t%s\t%s' % (title, stamp), value, exp_sec=preview_exp_sec)
 
-def get_schema_datatype(type_name):
-    return _get_cache('schema\tdatatype\t%s' % type_name)
 
+def set_wikiquery(q, email, value, generations):
+    key = 'model\twikiquery\t%s\t%s' % (q, email)
+    _set_wikiquery_entry(key, _wikiquery_entry(value, generations))
 
-def get_cardinalities(key):
-    try:
-        return c.get('schema\tcardinalities\t%s' % key)
-    except:
-        pass
+
+def set_data(title, value):
+    _set_cache('model\tdata\t%s' % title, value)
+
+
+def set_metadata(title, value):
+    _set_cache('model\tmetadata\t%s' % title, value)
+
+
+def set_hashbangs(title, value):
+    _set_cache('model\thashbangs\t%s' % title, value)
 
 
 def get_config():
-    return _get_cache('model\tconfig')
+    return _get_cache('model\tconfig', namespace='config')
 
 
 def get_rendered_body(title):
     return _get_cache('model\trendered_body\t%s' % title)
 
 
+def get_markdown_html(digest):
+    return _get_cache('model\tmarkdown\t%s' % digest)
+
+
+def get_preview(title, stamp):
+    return _get_cache('model\tpreview\t%s\t%s' % (title, stamp))
+
+
 def get_wikiquery(q, email):
-    return _get_cache('model\twikiquery\t%s\t%s' % (q, email))
+    entry = _get_cache('model\twikiquery\t%s\t%s' % (q, email))
+    if not isinstance(entry, dict) or entry.get('generations') is None:
+        return None
+    if _get_generations(entry['generations'].keys()) != entry['generations']:
+        return None
+    return entry['results']
 
 
 def get_data(title):
@@ -212,6 +405,7 @@ def get_hashbangs(title):
 
 
 def del_config():
+    _bump_generation('config')
     _del_cache('model\tconfig')
 
 
@@ -231,21 +425,251 @@ def del_hashbangs(title):
     _del_cache('model\thashbangs\t%s' % title)
 
 
-def _set_cache(key, value, exp_sec=0):
-    try:
+_page_key_formats = [
+    u'model\trendered_body\t%s',
+    u'model\thashbangs\t%s',
+    u'model\tmetadata\t%s',
+    u'model\tdata\t%s',
+]
+
+
+def _set_cache(key, value, exp_sec=0, namespace=None, stale_key=None):
+    if value is None:
+        exp_sec = min(exp_sec, negative_exp_sec) if exp_sec else negative_exp_sec
+    prc.set(key, value)
+    _store(key, _none if value is None else value, exp_sec)
+    if stale_key is not None and value is not None:
+        _store(stale_key, value, stale_exp_sec)
+    if namespace is not None:
+        _set_local(namespace, key, value)
+
+
+def _set_cache_multi(values, exp_sec=0):
+    """Sets values in a single memcache round trip, besides chunks of large ones"""
+    mapping = {}
+    for key, value in values.items():
         prc.set(key, value)
-        c.set(key, value, exp_sec)
+        try:
+            packed = _pack(key, value, exp_sec)
+        except Exception as e:
+            _count_uncacheable(key, repr(e))
+            continue
+        if packed is not None:
+            mapping[key] = packed
+    if len(mapping) == 0:
+        return
+
+    try:
+        failed = c.set_multi(mapping, exp_sec)
+    except Exception as e:
+        logging.warning(u'Cannot set %d values: %r' % (len(mapping), e))
+        failed = mapping.keys()
+    for key in failed:
+        _count_uncacheable(key, 'set failed')
+
+
+def _prefetch(keys):
+    keys = [key for key in keys if prc.get(key, _missing) is _missing]
+    if len(keys) == 0:
+        return
+
+    try:
+        values = c.get_multi(keys)
     except:
-        pass
+        return
+    for key in keys:
+        _count('memcache', key in values)
+        prc.set(key, _decode(_unpack(key, values.get(key))))
 
 
-def _get_cache(key):
-    if prc.get(key) is None:
-        try:
-            prc.set(key, c.get(key))
-        except:
-            pass
-    return prc.get(key)
+def _get_cache(key, namespace=None):
+    value = prc.get(key, _missing)
+    _count('prc', value is not _missing)
+    if value is not _missing:
+        return value
+
+    if namespace is not None:
+        value = _get_local(namespace, key)
+        if value is not None:
+            prc.set(key, value)
+            return value
+
+    value = _load(key)
+    _count('memcache', value is not None)
+    # misses are remembered too; whoever computes the value sets it again
+    value = _decode(value)
+    prc.set(key, value)
+    if value is not None and namespace is not None:
+        _set_local(namespace, key, value)
+    return value
+
+
+def _decode(value):
+    return None if value == _none else value
+
+
+def _wikiquery_entry(results, generations):
+    merged = {}
+    for g in generations:
+        if g is None:
+            merged = None
+            break
+        merged.update(g)
+    return {'results': results, 'generations': merged}
+
+
+def _set_wikiquery_entry(key, entry):
+    if entry['generations'] is None:
+        return
+    _set_cache(key, entry, wikiquery_exp_sec, stale_key=_stale_key(key))
+
+
+def _term_namespace(name, value):
+    term = u'%s\t%s' % (name, value)
+    return u'term\t%s' % hashlib.md5(term.encode('utf-8')).hexdigest()
+
+
+def _page_namespace(title):
+    return u'page\t%s' % hashlib.md5(title.encode('utf-8')).hexdigest()
+
+
+def _get_generations(namespaces):
+    """Returns current generations of namespaces from memcache, bypassing the local tier"""
+    keys = dict((u'generation\t%s' % namespace, namespace) for namespace in namespaces)
+    try:
+        values = c.get_multi(keys.keys())
+        missing = [key for key in keys if key not in values]
+        if missing:
+            c.add_multi(dict((key, int(time.time() * 1000)) for key in missing))
+            values.update(c.get_multi(missing))
+    except:
+        return None
+    if len(values) != len(keys):
+        return None
+    return dict((keys[key], value) for key, value in values.items())
+
+
+def _stale_key(key):
+    return u'stale\t%s' % key
+
+
+def _compute_once(key, stale_key, compute, store):
+    """Computes and stores the value of key while holding a lease on it.
+
+    If another request holds the lease, its stale copy is returned if any.
+    Otherwise this waits for the new value, and computes it anyway if the
+    other request does not finish within lease_wait_sec.
+    """
+    lease_key = u'lease\t%s' % key
+    try:
+        leased = c.add(lease_key, 1, lease_sec)
+    except:
+        leased = True
+
+    if not leased:
+        value = _load(stale_key) if stale_key is not None else None
+        if value is not None:
+            _count('stale', True)
+            return value
+
+        deadline = time.time() + lease_wait_sec
+        while time.time() < deadline:
+            time.sleep(lease_poll_sec)
+            value = _load(key)
+            if value is not None:
+                value = _decode(value)
+                prc.set(key, value)
+                return value
+        _count('stale', False)
+
+    try:
+        value = compute()
+        store(value)
+        return value
+    finally:
+        if leased:
+            try:
+                c.delete(lease_key)
+            except:
+                pass
+
+
+def _store(key, value, exp_sec=0, add=False):
+    """Sets value to memcache, compressing and chunking it if needed. Returns False if value is not cached.
+
+    With add, a value already cached under key is kept.
+    """
+    try:
+        packed = _pack(key, value, exp_sec)
+        if packed is None:
+            return False
+        if add:
+            return c.add(key, packed, exp_sec)
+        if not c.set(key, packed, exp_sec):
+            _count_uncacheable(key, 'set failed')
+            return False
+        return True
+    except Exception as e:
+        _count_uncacheable(key, repr(e))
+        return False
+
+
+def _pack(key, value, exp_sec=0):
+    """Returns what to set to memcache under key, or None if value cannot be cached.
+
+    Value is pickled once, here, and compressed if large. Chunks of values
+    still too large are written under a new version before the manifest
+    which refers to them is returned, so readers never mix chunks of
+    different writes. Chunks of older versions are left to expire.
+    """
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    if len(data) < compress_threshold:
+        return _pickled + data
+
+    data = zlib.compress(data)
+    if len(_zlib) + len(data) <= chunk_size:
+        return _zlib + data
+
+    version = '%016x' % random.getrandbits(64)
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    failed = c.set_multi(dict((_chunk_key(key, version, i), chunk) for i, chunk in enumerate(chunks)), exp_sec)
+    if failed:
+        _count_uncacheable(key, '%d of %d chunks failed' % (len(failed), len(chunks)))
+        return None
+    return '%s%s\0%d' % (_chunks, version, len(chunks))
+
+
+def _load(key):
+    try:
+        return _unpack(key, c.get(key))
+    except:
+        return None
+
+
+def _unpack(key, value):
+    """Returns value read from memcache, unpickled, decompressed and joined. None if any chunk is gone."""
+    if not isinstance(value, str):
+        return value
+    try:
+        if value.startswith(_pickled):
+            return cPickle.loads(value[len(_pickled):])
+        if value.startswith(_zlib):
+            return cPickle.loads(zlib.decompress(value[len(_zlib):]))
+        if value.startswith(_chunks):
+            version, count = value[len(_chunks):].split('\0')
+            keys = [_chunk_key(key, version, i) for i in range(int(count))]
+            chunks = c.get_multi(keys)
+            if len(chunks) != len(keys):
+                return None
+            return cPickle.loads(zlib.decompress(''.join(chunks[k] for k in keys)))
+    except Exception as e:
+        logging.warning(u'Cannot read cached %s: %r' % (key, e))
+        return None
+    return value
+
+
+def _chunk_key(key, version, index):
+    return u'chunk\t%s\t%d\t%s' % (version, index, key)
 
 
 def _del_cache(key):
@@ -254,3 +678,46 @@ def _del_cache(key):
         c.delete(key)
     except:
         pass
+
+
+def _get_local(namespace, key):
+    generation = _get_generation(namespace)
+    entry = local.get(key)
+    hit = entry is not None and generation is not None and entry[0] == generation
+    _count('local', hit)
+    return entry[1] if hit else None
+
+
+def _set_local(namespace, key, value, generation=None):
+    if generation is None:
+        generation = _get_generation(namespace)
+    if generation is not None:
+        local.set(key, (generation, value))
+
+
+def _get_generation(namespace):
+    """Returns current generation of namespace, as seen by this instance"""
+    key = 'generation\t%s' % namespace
+    generation = local.get(key)
+    if generation is None:
+        try:
+            generation = c.get(key)
+            if generation is None:
+                # start from a fresh number so that evicted counter never goes back
+                c.add(key, int(time.time() * 1000))
+                generation = c.get(key)
+        except:
+            generation = None
+        if generation is None:
+            return None
+        local.set(key, generation, generation_ttl)
+    return generation
+
+
+def _bump_generation(namespace):
+    key = 'generation\t%s' % namespace
+    local.delete(key)
+    try:
+        c.incr(key, initial_value=int(time.time() * 1000))
+    except:
+        pass
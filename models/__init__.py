@@ -2,9 +2,12 @@
 
 from utils import *
 from toc_generator import TocGenerator
+from html_postprocessor import HtmlPostProcessor
 from conflict_error import ConflictError
 from user_preferences import UserPreferences
 from page_operation_mixin import PageOperationMixin
+from page_analysis import PageAnalysis
 from wiki_page_revision import WikiPageRevision
 from schema_data_index import SchemaDataIndex
+from rendered_body import RenderedBody
 from wiki_page import WikiPage
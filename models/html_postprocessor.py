@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import re
+from cgi import escape
+from lxml import etree
+from lxml.html import fragment_fromstring
+from lxml.html.clean import Cleaner
+
+from models import TocGenerator
+
+
+cleaner = Cleaner(safe_attrs_only=False)
+cleaner.host_whitelist = (
+    'www.youtube.com',
+    'player.vimeo.com',
+    'embed.ted.com',
+    'prezi.com',
+    'www.google.com',
+    'www.slideshare.net',
+    'maps.google.com',
+    'docs.google.com'
+)
+cleaner.forms = False
+
+
+class HtmlPostProcessor(object):
+    """Finishes rendered HTML of a page in a single lxml pass.
+
+    Adds table of contents and heading anchors, marks elements holding only
+    an image, sanitizes and finds hashbangs on one element tree, which is
+    parsed and serialized once.
+    """
+    re_mathjax = re.compile(ur'\\\(.+\\\)|\$\$.+\$\$', re.DOTALL)
+    heading_tags = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self, html, structured_data=u''):
+        self._html = html
+        self._structured_data = structured_data
+
+    def process(self):
+        """Returns finished HTML and hashbangs found in it"""
+        html = self._structured_data + self._html
+        if not html:
+            return html, []
+
+        root = fragment_fromstring(html, create_parent='div')
+        headings = self._headings(root)
+        self._add_toc(headings, *self._outline(headings))
+        self._mark_images(root)
+        cleaner(root)
+        hashbangs = self._hashbangs(root)
+        return self._inner_html(root), hashbangs
+
+    def _headings(self, root):
+        # structured data block has its own heading, which is not a part of the body
+        if self._structured_data and len(root):
+            excluded = set(root[0].iter(*self.heading_tags))
+        else:
+            excluded = set()
+        elements = [h for h in root.iter(*self.heading_tags) if h not in excluded and (h.text or len(h))]
+
+        # anchors are hashed from headings as markdown writes them, which lxml
+        # would serialize differently for entities and void tags
+        sources = TocGenerator.extract_headings(self._html)
+        if [level for level, _ in sources] == [int(h.tag[1]) for h in elements]:
+            return [(h, inner) for h, (_, inner) in zip(elements, sources)]
+        return [(h, self._inner_html(h)) for h in elements]
+
+    def invalid_toc_reason(self):
+        """Returns why headings cannot make a table of contents, or False"""
+        if not self._html:
+            return False
+        try:
+            self._outline(self._headings(fragment_fromstring(self._html, create_parent='div')))
+            return False
+        except ValueError as e:
+            return e.message
+
+    @staticmethod
+    def _outline(headings):
+        generator = TocGenerator(None)
+        outlines = generator.generate_outline([(int(h.tag[1]), inner) for h, inner in headings])
+        return outlines, generator.generate_path(outlines)
+
+    def _add_toc(self, headings, outlines, paths):
+        texts = dict((inner, h.text_content()) for h, inner in headings)
+
+        for (h, _), path in zip(headings, paths):
+            hashed = TocGenerator.hash_str(path)
+            if len(h):
+                h[-1].tail = (h[-1].tail or u'') + u' '
+            else:
+                h.text += u' '
+            anchor = etree.SubElement(h, 'a')
+            anchor.set('id', u'h_%s' % hashed)
+            anchor.set('href', u'#h_%s' % hashed)
+            anchor.set('class', 'caret-target')
+            anchor.text = u'#'
+
+        # insert table of contents before first heading
+        if len(headings) > 4:
+            toc = etree.Element('div')
+            toc.set('class', 'toc')
+            etree.SubElement(toc, 'h1').text = u'Table of Contents'
+            self._append_toc_list(toc, outlines, iter(paths), texts)
+            first = headings[0][0]
+            first.addprevious(toc)
+
+    def _append_toc_list(self, parent, outlines, path_iter, texts):
+        if len(outlines) == 0:
+            return
+
+        ol = etree.SubElement(parent, 'ol')
+        for title, children in outlines:
+            hashed = TocGenerator.hash_str(path_iter.next())
+            li = etree.SubElement(ol, 'li')
+            a = etree.SubElement(etree.SubElement(li, 'div'), 'a')
+            a.set('href', u'#h_%s' % hashed)
+            a.text = texts[title]
+            self._append_toc_list(li, children, path_iter, texts)
+
+    def _mark_images(self, root):
+        # only images from markdown, which always have alt. embedded ones keep their markup
+        for img in root.iter('img'):
+            parent = img.getparent()
+            if img.get('alt') is None or parent is root or len(parent) != 1:
+                continue
+            if (parent.text or u'').strip() or (img.tail or u'').strip():
+                continue
+            classes = parent.get('class')
+            parent.set('class', u'%s img-container' % classes if classes else u'img-container')
+            parent.text = img.tail = None
+
+    def _hashbangs(self, root):
+        hashbangs = []
+        for code in root.iter('code'):
+            text = code.text_content()
+            if not text.startswith(u'#!'):
+                continue
+            m = re.match(ur'#!([^\n;]+)', text)
+            if m:
+                hashbangs.append(m.group(1))
+
+        if self.re_mathjax.search(root.text_content()):
+            hashbangs.append('mathjax')
+        return hashbangs
+
+    @staticmethod
+    def _inner_html(element):
+        return escape(element.text or u'') + u''.join(etree.tostring(child, encoding=unicode, method='html')
+                                                      for child in element)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import schema
+import hashlib
+from datetime import date, datetime
+from markdownext import md_wikilink
+
+from models import HtmlPostProcessor
+from models import PageOperationMixin
+
+
+def _memoized(func):
+    name = '_%s' % func.__name__
+
+    def getter(self):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            value = func(self)
+            setattr(self, name, value)
+            return value
+    return property(getter, doc=func.__doc__)
+
+
+def _to_raw(value):
+    if type(value) == list:
+        return [_to_raw(v) for v in value]
+    elif isinstance(value, schema.Property):
+        return _to_raw(value.pvalue)
+    elif isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    else:
+        return value
+
+
+class PageAnalysis(object):
+    """Everything derived from a single body of a page.
+
+    Each part is parsed on first access and kept for the lifetime of the
+    object, so that validation, description, outlinks and schema data of
+    one revision share the same parse. Parse errors are not kept and are
+    raised again on next access.
+
+    Metadata and raw schema data can be dumped into a JSON-compatible dict
+    and restored later, so that a stored page does not need to parse its
+    body again. Bump VERSION whenever parsing changes its output.
+    """
+    VERSION = 1
+
+    def __init__(self, title, body):
+        self.title = title
+        self.body = body
+        self._restored_rawdata = None
+
+    def dump(self):
+        return {
+            'version': PageAnalysis.VERSION,
+            'body_hash': self.body_hash,
+            'metadata': self.metadata,
+            'data': self.rawdata,
+        }
+
+    def restore(self, dumped):
+        if dumped is None or dumped.get('version') != PageAnalysis.VERSION:
+            return False
+        if dumped.get('body_hash') != self.body_hash:
+            return False
+        self._metadata = dumped['metadata']
+        self._restored_rawdata = dumped['data']
+        return True
+
+    @_memoized
+    def body_hash(self):
+        return hashlib.md5(self.body.encode('utf-8')).hexdigest()
+
+    @_memoized
+    def metadata(self):
+        return PageOperationMixin.parse_metadata(self.body)
+
+    @property
+    def itemtype(self):
+        if 'schema' in self.metadata:
+            return self.metadata['schema']
+        else:
+            return u'Article'
+
+    @_memoized
+    def content(self):
+        """Body without metadata"""
+        return PageOperationMixin.remove_metadata(self.body)
+
+    @_memoized
+    def stripped_content(self):
+        """Body without metadata and yaml/schema block"""
+        return PageOperationMixin.remove_yaml_schema(self.content)
+
+    @_memoized
+    def description(self):
+        return PageOperationMixin.summarize(self.stripped_content.strip())
+
+    @_memoized
+    def yaml_data(self):
+        return PageOperationMixin.parse_schema_yaml(self._normalized_body)
+
+    @_memoized
+    def body_data(self):
+        return PageOperationMixin.parse_body_data(self._normalized_body)
+
+    @_memoized
+    def sections(self):
+        if self._normalized_body is self.body:
+            stripped_content = self.stripped_content
+        else:
+            stripped_content = PageOperationMixin.remove_yaml_schema(PageOperationMixin.remove_metadata(self._normalized_body))
+        return PageOperationMixin.split_sections(stripped_content, PageOperationMixin.default_section(self.itemtype))
+
+    @_memoized
+    def data(self):
+        """Typed schema data. Shared by every user of this analysis; copy before modifying."""
+        if self._restored_rawdata is not None:
+            return schema.SchemaConverter.convert(self.itemtype, self._restored_rawdata)
+        return PageOperationMixin.convert_data(self.title, self.itemtype, self.yaml_data, self.body_data, self.sections)
+
+    @_memoized
+    def rawdata(self):
+        """Schema data as JSON-compatible values"""
+        return dict((name, _to_raw(value)) for name, value in self.data.items())
+
+    @_memoized
+    def wikilinks(self):
+        return md_wikilink.parse_wikilinks(self.itemtype, self.content)
+
+    @_memoized
+    def html(self):
+        """Html of the body alone. Shares the markdown cache with rendered_body"""
+        return PageOperationMixin.render_blocks(self.stripped_content)
+
+    @_memoized
+    def invalid_toc_reason(self):
+        return HtmlPostProcessor(self.html).invalid_toc_reason()
+
+    @_memoized
+    def _normalized_body(self):
+        if u'\r\n' in self.body:
+            return self.body.replace(u'\r\n', u'\n')
+        return self.body
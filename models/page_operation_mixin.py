@@ -4,19 +4,30 @@ import re
 import acl
 import yaml
 import schema
+import caching
+import hashlib
 import operator
 import urllib2
+import zlib
+import logging
+from cgi import escape
 from collections import OrderedDict
 from yaml.parser import ParserError
-from lxml.html.clean import Cleaner
+from markdown.util import isBlockLevel
+from markdown.preprocessors import HtmlBlockPreprocessor
 
+from markdownext import md_embed
 from models import md
-from models import TocGenerator
+from models import HtmlPostProcessor
 from models.utils import merge_dicts, pairs_to_dict, get_cur_user
 
 
+# bump whenever markdown extensions, render_blocks or HtmlPostProcessor change
+# their output, so that stored rendered bodies are rendered again
+RENDER_VERSION = 1
+
+
 class PageOperationMixin(object):
-    re_img = re.compile(ur'<(.+?)>[\n\t\s]*<img( .+? )/>[\n\t\s]*</(.+?)>')
     re_metadata = re.compile(ur'^\.([^\s]+)(\s+(.+))?$')
     re_data = re.compile(ur'({{|\[\[)(?P<name>[^\]}]+)::(?P<value>[^\]}]+)(}}|\]\])')
     re_section_data = re.compile(ur'''^(?P<name>[^\s]+?)::---+$''')
@@ -33,12 +44,19 @@ class PageOperationMixin(object):
             )+
         )
     ''', re.VERBOSE + re.MULTILINE + re.DOTALL)
+    re_reference = re.compile(ur'^ {0,3}\[[^\]]+\]:', re.MULTILINE)
+    re_continuation = re.compile(ur'[>:<|{]')
+    re_list_item = re.compile(ur'[ ]{0,3}([*+-]|\d+\.)\s')
+    re_definition = re.compile(ur'[ ]{0,3}:')
     re_conflicted = re.compile(ur'<<<<<<<.+=======.+>>>>>>>', re.DOTALL)
     re_special_titles_years = re.compile(ur'^(10000|\d{1,4})( BCE)?$')
     re_special_titles_dates = re.compile(ur'^((?P<month>January|February|March|'
                                          ur'April|May|June|July|August|'
                                          ur'September|October|November|'
                                          ur'December)( (?P<date>[0123]?\d))?)$')
+    # average number of blocks in a piece of rendered body without headings
+    piece_blocks = 8
+    _html_block = HtmlBlockPreprocessor()
 
     @property
     def rendered_data(self):
@@ -76,7 +94,11 @@ class PageOperationMixin(object):
 
     @property
     def rendered_body(self):
-        return PageOperationMixin.render_body(self.title, self.body, self.rendered_data, self.inlinks, self.related_links_by_score, self.older_title, self.newer_title)
+        return self.render()[0]
+
+    def render(self):
+        """Returns rendered body and its hashbangs"""
+        return PageOperationMixin.render_page(self.title, self.body, self.rendered_data, self.inlinks, self.related_links_by_score, self.older_title, self.newer_title)
 
     @property
     def paths(self):
@@ -107,9 +129,17 @@ class PageOperationMixin(object):
     def absolute_older_url(self):
         return u'/%s' % PageOperationMixin.title_to_path(self.older_title)
 
+    @property
+    def analysis(self):
+        analysis = getattr(self, '_analysis', None)
+        if analysis is None or analysis.title != self.title or analysis.body != self.body:
+            analysis = self._create_analysis()
+            self._analysis = analysis
+        return analysis
+
     @property
     def data(self):
-        data = PageOperationMixin.parse_data(self.title, self.body, self.itemtype)
+        data = dict(self.analysis.data)
         data['datePageModified'] = schema.DateTimeProperty(self.itemtype, 'DateTime', 'datePageModified', self.updated_at)
         return data
 
@@ -119,7 +149,7 @@ class PageOperationMixin(object):
 
     @property
     def metadata(self):
-        return PageOperationMixin.parse_metadata(self.body)
+        return self.analysis.metadata
 
     @property
     def itemtype(self):
@@ -179,6 +209,10 @@ class PageOperationMixin(object):
     def can_write(self, user, default_acl=None, acl_r=None, acl_w=None):
         return acl.ACL(default_acl, self.acl_read, self.acl_write).can_write(user, acl_r, acl_w)
 
+    def _create_analysis(self):
+        from models.page_analysis import PageAnalysis
+        return PageAnalysis(self.title, self.body)
+
     def _get_raw_data_value(self, value):
         if type(value) == list:
             return [self._get_raw_data_value(v) for v in value]
@@ -248,9 +282,12 @@ class PageOperationMixin(object):
     @staticmethod
     def make_description(body, max_length=200):
         # remove yaml/schema block and metadata
-        body = re.sub(PageOperationMixin.re_yaml_schema, u'\n', body)
+        body = PageOperationMixin.remove_yaml_schema(body)
         body = PageOperationMixin.remove_metadata(body).strip()
+        return PageOperationMixin.summarize(body, max_length)
 
+    @staticmethod
+    def summarize(body, max_length=200):
         # try newline
         index = body.find(u'\n')
         if index != -1:
@@ -273,28 +310,6 @@ class PageOperationMixin(object):
         # just cut-off
         return body[:max_length - 3].strip() + u'...'
 
-    @staticmethod
-    def sanitize_html(rendered):
-        if rendered:
-            cleaner = Cleaner(safe_attrs_only=False)
-            cleaner.host_whitelist = (
-                'www.youtube.com',
-                'player.vimeo.com',
-                'embed.ted.com',
-                'prezi.com',
-                'www.google.com',
-                'www.slideshare.net',
-                'maps.google.com',
-                'docs.google.com'
-            )
-            cleaner.forms = False
-            rendered = cleaner.clean_html(rendered)
-
-            # remove div wrapper if there is one
-            if rendered.startswith('<div>'):
-                rendered = rendered[5:-6]
-        return rendered
-
     @staticmethod
     def title_to_path(path):
         return urllib2.quote(path.replace(u' ', u'_').encode('utf-8'))
@@ -329,60 +344,71 @@ class PageOperationMixin(object):
     def parse_data(cls, title, body, itemtype=u'Article'):
         body = body.replace('\r\n', '\n')
 
-        default_data = {'name': title, 'schema': schema.get_itemtype_path(itemtype)}
-
         # collect
         yaml_data = cls.parse_schema_yaml(body)
-        body_data = pairs_to_dict((m.group('name'), m.group('value')) for m in re.finditer(cls.re_data, body))
+        body_data = cls.parse_body_data(body)
+        section_data = cls.parse_sections(body, cls.default_section(itemtype))
+
+        return cls.convert_data(title, itemtype, yaml_data, body_data, section_data)
+
+    @classmethod
+    def parse_body_data(cls, body):
+        return pairs_to_dict((m.group('name'), m.group('value')) for m in re.finditer(cls.re_data, body))
+
+    @staticmethod
+    def default_section(itemtype):
+        if itemtype == u'Article':
+            return u'articleBody'
+
+        try:
+            ancestors = schema.get_schema(itemtype)[u'ancestors']
+        except KeyError:
+            raise ValueError('Unknown itemtype: %s' % itemtype)
 
-        if itemtype == u'Article' or u'Article' in schema.get_schema(itemtype)[u'ancestors']:
-            default_section = u'articleBody'
+        if u'Article' in ancestors:
+            return u'articleBody'
         else:
-            default_section = u'longDescription'
-        section_data = cls.parse_sections(body, default_section)
+            return u'longDescription'
+
+    @staticmethod
+    def convert_data(title, itemtype, yaml_data, body_data, section_data):
+        default_data = {'name': title, 'schema': schema.get_itemtype_path(itemtype)}
 
         # merge
         data = merge_dicts([default_data, yaml_data, body_data, section_data])
 
         # validation and type conversion
-        typed = schema.SchemaConverter.convert(itemtype, data)
-
-        return typed
+        return schema.SchemaConverter.convert(itemtype, data)
 
     @classmethod
     def parse_sections(cls, body, default_section=u'articleBody'):
         # remove metadata and yaml schema block
-        body = cls.remove_metadata(body)
-        body = re.sub(PageOperationMixin.re_yaml_schema, u'\n', body).strip()
-        lines = body.split('\n')
+        body = cls.remove_yaml_schema(cls.remove_metadata(body))
+        return cls.split_sections(body, default_section)
 
-        # append default section
-        if not cls.re_section_data.match(lines[0]):
-            lines.insert(0, u'%s::---' % default_section)
+    @classmethod
+    def split_sections(cls, body, default_section=u'articleBody'):
+        lines = body.strip().split('\n')
 
-        i = 0
         sections = {}
         section_name = None
-        section_lines = None
+        section_lines = []
+
+        # lines before the first section belong to the default section
+        if not cls.re_section_data.match(lines[0]):
+            section_name = default_section
 
-        while i < len(lines):
-            m = cls.re_section_data.match(lines[i])
+        for line in lines:
+            m = cls.re_section_data.match(line)
             if m:
-                if section_name is None:
-                    # Found first section. Start new one
-                    section_name = m.group('name')
-                    section_lines = []
-                else:
-                    # Found other section. Close current one and start the new one
+                # Found new section. Close current one if any and start the new one
+                if section_name is not None:
                     sections[section_name] = '\n'.join(section_lines).strip()
-                    section_name = m.group('name')
-                    section_lines = []
+                section_name = m.group('name')
+                section_lines = []
             else:
                 # In the section. Collect lines
-                section_lines.append(lines[i])
-
-            # Remove this line
-            lines.pop(i)
+                section_lines.append(line)
 
         if section_name:
             sections[section_name] = '\n'.join(section_lines).strip()
@@ -392,13 +418,7 @@ class PageOperationMixin(object):
     @classmethod
     def parse_metadata(cls, body):
         # extract lines
-        matches = []
-        for line in body.split(u'\n'):
-            m = re.match(cls.re_metadata, line.strip())
-            if m:
-                matches.append(m)
-            else:
-                break
+        matches, offset = cls._scan_metadata(body)
 
         # default values
         metadata = {
@@ -416,7 +436,7 @@ class PageOperationMixin(object):
         if u'pub' in metadata and u'redirect' in metadata:
             raise ValueError('You cannot use "pub" and "redirect" metadata at '
                              'the same time.')
-        if u'redirect' in metadata and len(PageOperationMixin.remove_metadata(body).strip()) != 0:
+        if u'redirect' in metadata and len(body[offset:].strip()) != 0:
             raise ValueError('Page with "redirect" metadata cannot have a body '
                              'content.')
         if u'read' in metadata and metadata['content-type'] != 'text/x-markdown':
@@ -427,29 +447,269 @@ class PageOperationMixin(object):
 
     @staticmethod
     def remove_metadata(body):
-        rest = []
-        lines = iter(body.split(u'\n'))
+        return body[PageOperationMixin._scan_metadata(body)[1]:]
 
-        for line in lines:
-            m = re.match(PageOperationMixin.re_metadata, line.strip())
+    @staticmethod
+    def _scan_metadata(body):
+        """Returns matches of leading metadata lines and offset of the rest of the body"""
+        matches = []
+        offset = 0
+        while True:
+            end = body.find(u'\n', offset)
+            line = body[offset:] if end == -1 else body[offset:end]
+            m = PageOperationMixin.re_metadata.match(line.strip())
             if m is None:
-                rest.append(line)
-                break
+                return matches, offset
+            matches.append(m)
+            if end == -1:
+                return matches, len(body)
+            offset = end + 1
+
+    @staticmethod
+    def render_markdown(text):
+        digest = PageOperationMixin._markdown_digest(text)
+        html = caching.get_markdown_html(digest)
+        if html is None:
+            html = md.convert(text)
+            caching.set_markdown_html(digest, html)
+        return html
+
+    @staticmethod
+    def render_blocks(text):
+        """Renders markdown same as render_markdown, reusing cached html of unchanged blocks.
+
+        Each block (see split_blocks) is rendered and cached on its own, so that
+        an edit in a long page converts only the blocks it touches.
+        """
+        groups = PageOperationMixin.split_blocks(text)
+        digests = dict((block, PageOperationMixin._markdown_digest(block))
+                       for _, blocks in groups for block in blocks)
+        caching.prefetch_markdown_htmls(digests.values())
+
+        converted = {}
+        parts = []
+        for itemprop, blocks in groups:
+            htmls = []
+            for block in blocks:
+                digest = digests[block]
+                html = converted[digest] if digest in converted else caching.get_markdown_html(digest)
+                if html is None:
+                    html = converted[digest] = md.convert(block)
+                htmls.append(html)
+            inner = u'\n'.join(html for html in htmls if html)
+            if itemprop is None:
+                parts.append(inner)
+            else:
+                parts.append(u'<div class="section" itemprop="%s">%s</div>' %
+                             (escape(itemprop, True), u'\n%s\n' % inner if inner else u''))
+        caching.set_markdown_htmls(converted)
+        return u'\n'.join(part for part in parts if part)
+
+    @staticmethod
+    def split_blocks(text):
+        """Splits markdown into blocks which render the same alone as in the whole text.
+
+        Returns a list of (itemprop, blocks) for each `name::---` section, where
+        itemprop is None for the text out of sections. Blocks are split only at
+        a single blank line followed by an unindented line which cannot continue
+        a list, quote, definition, table or raw html above it.
+
+        The whole text is a single block wherever a boundary is ambiguous: raw
+        html is left open at the end, or cannot be followed the way markdown does.
+        """
+        try:
+            return PageOperationMixin._split_blocks(text)
+        except (AttributeError, TypeError, ValueError, IndexError) as e:
+            # raw html is followed with private helpers of markdown
+            logging.warning(u'Cannot split markdown into blocks: %s' % e)
+            return [(None, [text])]
+
+    @staticmethod
+    def _split_blocks(text):
+        # reference-style links may be defined anywhere in the text
+        if PageOperationMixin.re_reference.search(text):
+            return [(None, [text])]
+
+        lines = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n').split(u'\n')
+        # markdown keeps whitespaces only in the first line, as an empty code block
+        if lines[0] and not lines[0].strip(u' \t'):
+            return [(None, [text])]
+
+        paragraphs = PageOperationMixin._paragraphs(lines)
+        # [first line, end line, itemprop, blocks, ends with raw html, cannot be split]
+        groups = [[0, len(lines), None, [], False, False]]
+        open_tag = None
+        for i, (first, end) in enumerate(paragraphs):
+            group = groups[-1]
+            head = lines[first]
+            prev_first, prev_end = paragraphs[i - 1] if i > 0 else (None, None)
+            single_blank = prev_end is None or first - prev_end == 1
+
+            m = PageOperationMixin.re_section_data.match(head)
+            if m and end - first == 1 and open_tag is None and not group[5]:
+                # markdown sees a section after two or more blank lines as a
+                # block starting with a newline, which nests in the current
+                # section or takes a blank line into a code block above.
+                # the rest is rendered at once then
+                if single_blank or (group[2] is None and not lines[prev_first][0].isspace()):
+                    group[1] = first
+                    groups.append([first, len(lines), m.group('name'), [], False, False])
+                    continue
+                group[5] = True
+            elif any(PageOperationMixin.re_section_data.match(l) for l in lines[first + 1:end]):
+                # a block processor may leave it alone as a block
+                group[5] = True
+
+            blocks = group[3]
+            if len(blocks) == 0:
+                blocks.append([first, end])
+            elif group[4] or group[5] or open_tag is not None or not single_blank or \
+                    not PageOperationMixin._starts_block(lines, paragraphs, i):
+                blocks[-1][1] = end
+            else:
+                blocks.append([first, end])
+
+            # raw html is followed by an extra newline, unless it ends the whole text
+            group[4] = open_tag is not None or any(l.startswith(u'<') or md_embed.p.search(l.strip())
+                                                   for l in lines[first:end])
+            # embedded html is closed by itself
+            html_first = first + 1 if md_embed.p.search(head.strip()) else first
+            open_tag = PageOperationMixin._open_html_tag(u'\n'.join(lines[html_first:end]), open_tag)
+
+        # markdown takes the rest of the text into unclosed raw html
+        if open_tag is not None:
+            return [(None, [text])]
+        # trailing blank lines belong to the last block, as in the whole text
+        if len(groups[-1][3]):
+            groups[-1][3][-1][1] = len(lines)
+
+        # groups which cannot be wrapped or joined with others are rendered as a whole
+        merged = []
+        for group in groups:
+            first, end, itemprop, blocks, glued, unsplittable = group
+            if len(merged) and merged[-1][4]:
+                first = merged.pop()[0]
+                merged.append([first, end, None, [[first, end]], glued])
+            elif (itemprop is not None and glued) or unsplittable:
+                merged.append([first, end, None, [[first, end]], glued])
+            else:
+                merged.append(group)
+
+        return [(group[2], [u'\n'.join(lines[first:end]) for first, end in PageOperationMixin._pieces(lines, group[3])])
+                for group in merged]
+
+    @staticmethod
+    def _pieces(lines, blocks):
+        """Joins blocks into pieces, each worth a conversion of its own.
+
+        A piece ends before a heading or after a block chosen by its content,
+        so that an edit moves no boundaries but ones around the edited block.
+        """
+        pieces = []
+        last = None
+        for first, end in blocks:
+            if last is None or lines[first].startswith(u'#') or \
+                    zlib.crc32(u'\n'.join(lines[last[0]:last[1]]).encode('utf-8')) % PageOperationMixin.piece_blocks == 0:
+                pieces.append([first, end])
+            else:
+                pieces[-1][1] = end
+            last = first, end
+        return pieces
+
+    @staticmethod
+    def _paragraphs(lines):
+        """Returns (first, end) line ranges of runs of non-blank lines"""
+        paragraphs = []
+        first = None
+        for i, line in enumerate(lines):
+            if line.strip(u' \t'):
+                if first is None:
+                    first = i
+            elif first is not None:
+                paragraphs.append((first, i))
+                first = None
+        if first is not None:
+            paragraphs.append((first, len(lines)))
+        return paragraphs
+
+    @staticmethod
+    def _starts_block(lines, paragraphs, i):
+        first, end = paragraphs[i]
+        if lines[first][0].isspace() or PageOperationMixin.re_continuation.match(lines[first]):
+            return False
+        # list items continue a list above
+        if PageOperationMixin.re_list_item.match(lines[first]):
+            prev_first, prev_end = paragraphs[i - 1]
+            if lines[prev_first][0].isspace() or \
+                    any(PageOperationMixin.re_list_item.match(line) for line in lines[prev_first:prev_end]):
+                return False
+        # definitions join a definition list above. ones without a term take
+        # the paragraph before them as a term
+        if any(PageOperationMixin.re_definition.match(line) for line in lines[first:end]):
+            return False
+        if i + 1 < len(paragraphs) and PageOperationMixin.re_definition.match(lines[paragraphs[i + 1][0]]):
+            return False
+        return True
+
+    @staticmethod
+    def _open_html_tag(block, left_tag):
+        """Returns tag of raw html left open after a block, following HtmlBlockPreprocessor"""
+        html = PageOperationMixin._html_block
+        while True:
+            if left_tag is None:
+                if not block.startswith(u'<') or len(block.strip()) <= 1:
+                    return None
+                if block[1] == u'!':
+                    left_tag, left_index = u'--', 2
+                else:
+                    left_tag, left_index, _ = html._get_left_tag(block)
+                block_level = isBlockLevel(left_tag) or left_tag == u'--'
+                if not block_level and block[1] not in u'?@%':
+                    return None
+                right_tag, data_index = html._get_right_tag(left_tag, left_index, block)
+                rest = block[data_index:] if block_level else u''
+                block = block[:len(block) - len(rest)]
+                closed = html._is_oneliner(left_tag) or \
+                    (block.rstrip().endswith(u'>') and html._equal_tags(left_tag, right_tag)) or \
+                    not (isBlockLevel(left_tag) or left_tag == u'--' and not block.rstrip().endswith(u'>'))
+                if closed:
+                    left_tag = None
+            else:
+                right_tag, data_index = html._get_right_tag(left_tag, 0, block)
+                if not html._equal_tags(left_tag, right_tag):
+                    return left_tag
+                rest = block[data_index:]
+                left_tag = None
 
-        rest += list(lines)
-        return u'\n'.join(rest)
+            if not rest:
+                return left_tag
+            # same as markdown, the rest is a next block without leading newlines
+            block = rest[2:] if rest.startswith(u'\n\n') else rest[1:] if rest.startswith(u'\n') else rest
+
+    @staticmethod
+    def _markdown_digest(text):
+        return hashlib.md5((u'%s\n%s\n%s' % (RENDER_VERSION, md.context, text)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def remove_yaml_schema(body):
+        return re.sub(PageOperationMixin.re_yaml_schema, u'\n', body)
 
     @staticmethod
     def extract_hashbangs(html):
         matches = re.findall(ur'<code>#!(.+?)[\n;]', html)
-        if re.match(ur'.*(\\\(.+\\\)|\$\$.+\$\$)', html, re.DOTALL):
+        if re.search(ur'\\\(.+\\\)|\$\$.+\$\$', html, re.DOTALL):
             matches.append('mathjax')
         return matches
 
     @classmethod
     def render_body(cls, title, body, rendered_data='', inlinks={}, related_links_by_score={}, older_title=None, newer_title=None):
-        # body
-        body_parts = [cls.remove_metadata(body)]
+        return cls.render_page(title, body, rendered_data, inlinks, related_links_by_score, older_title, newer_title)[0]
+
+    @classmethod
+    def render_page(cls, title, body, rendered_data='', inlinks={}, related_links_by_score={}, older_title=None, newer_title=None):
+        """Returns rendered body and its hashbangs"""
+        # body without metadata and yaml/schema block
+        body_parts = [cls.remove_yaml_schema(cls.remove_metadata(body))]
 
         # incoming links
         if len(inlinks) > 0:
@@ -470,8 +730,8 @@ class PageOperationMixin(object):
             lines = [u'# Suggested Pages']
             lines += [u'* {{.score::%.3f}} [[%s]]\n{.noli}' % (score, t)
                       for t, score in related_links.items()[:10]]
+            lines.append(u'* [More suggestions...](/+%s)\n{.more-suggestions}' % (cls.title_to_path(title)))
             body_parts.append(u'\n'.join(lines))
-            body_parts.append(u'* [More suggestions...](/+%s)\n{.more-suggestions}' % (cls.title_to_path(title)))
 
         # other posts
         if older_title or newer_title:
@@ -482,19 +742,11 @@ class PageOperationMixin(object):
                 lines.append(u'* {{.older::older}} [[%s]]\n{.noli}' % older_title)
             body_parts.append(u'\n'.join(lines))
 
-        # remove yaml/schema block
-        joined = u'\n'.join(body_parts)
-        joined = re.sub(PageOperationMixin.re_yaml_schema, u'\n', joined)
-
-        # render to html
-        rendered = md.convert(joined)
-
-        # add table of contents
-        rendered = TocGenerator(rendered).add_toc()
-
-        # add class for embedded image
-        rendered = PageOperationMixin.re_img.sub(ur'<\1 class="img-container"><img\2/></\3>', rendered)
+        # render to html. each part is rendered and cached separately so that
+        # a change in links does not render the whole body again, and so is
+        # each block of the body so that an edit does not either
+        rendered = [cls.render_blocks(body_parts[0])] + [cls.render_markdown(part) for part in body_parts[1:]]
+        rendered = u'\n'.join(html for html in rendered if html)
 
-        # add structured data block
-        rendered = rendered_data + rendered
-        return cls.sanitize_html(rendered)
+        # table of contents, image classes, sanitization and hashbangs in one pass
+        return HtmlPostProcessor(rendered, rendered_data).process()
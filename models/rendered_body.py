@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from google.appengine.ext import ndb
+
+
+class RenderedBody(ndb.Model):
+    """Durable copy of WikiPage.rendered_body, keyed by page title.
+
+    Survives memcache evictions and flushes. An entry is valid only while its
+    stamp equals the render stamp of the page, which covers everything the
+    rendered body depends on, so it never has to be deleted explicitly.
+    """
+    _use_memcache = False
+
+    stamp = ndb.StringProperty(indexed=False)
+    html = ndb.TextProperty(compressed=True)
+
+    @classmethod
+    def get_html(cls, title, stamp):
+        entity = cls.get_by_id(title)
+        if entity is None or entity.stamp != stamp:
+            return None
+        return entity.html
+
+    @classmethod
+    def set_html(cls, title, stamp, html):
+        cls(id=title, stamp=stamp, html=html).put()
+
+    @classmethod
+    def delete(cls, title):
+        ndb.Key(cls, title).delete()
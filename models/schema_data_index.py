@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import schema
+import caching
 from google.appengine.ext import ndb
 
 
@@ -11,8 +12,8 @@ class SchemaDataIndex(ndb.Model):
     @classmethod
     def rebuild_index(cls, title, data):
         # delete
-        keys = [i.key for i in cls.query_by_title(title).fetch()]
-        ndb.delete_multi(keys)
+        olds = cls.query_by_title(title).fetch()
+        ndb.delete_multi([i.key for i in olds])
 
         # insert
         entities = [cls(title=title, name=name, value=unicode(v.pvalue if isinstance(v, schema.Property) else v))
@@ -20,6 +21,9 @@ class SchemaDataIndex(ndb.Model):
                     if not isinstance(v, schema.Property) or v.should_index()]
         ndb.put_multi(entities)
 
+        terms = [(i.name, i.value) for i in olds + entities]
+        caching.del_wikiquery_dependencies(terms, [title])
+
     @classmethod
     def update_index(cls, title, old_data, new_data):
         old_pairs = cls.data_as_pairs(old_data)
@@ -46,6 +50,11 @@ class SchemaDataIndex(ndb.Model):
         if len(entities) > 0:
             ndb.put_multi(entities)
 
+        # invalidate wikiquery results matching changed terms or showing data of this page
+        if len(deletes) > 0 or len(inserts) > 0:
+            terms = cls.index_terms(old_pairs).symmetric_difference(cls.index_terms(new_pairs))
+            caching.del_wikiquery_dependencies(terms, [title])
+
     @classmethod
     def query_by_title(cls, title):
         return cls.query(cls.title == title)
@@ -58,6 +67,12 @@ class SchemaDataIndex(ndb.Model):
     def has_match(cls, title, name, v):
         return cls.query(cls.title == title, cls.name == name, cls.value == unicode(v.pvalue if isinstance(v, schema.Property) else v)).count() > 0
 
+    @staticmethod
+    def index_terms(pairs):
+        return set((name, unicode(v.pvalue if isinstance(v, schema.Property) else v))
+                   for name, v in pairs
+                   if not isinstance(v, schema.Property) or v.should_index())
+
     @staticmethod
     def data_as_pairs(data):
         pairs = set()
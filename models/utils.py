@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-import caching
 import markdown
+import threading
 from markdown.extensions.def_list import DefListExtension
 from markdown.extensions.attr_list import AttrListExtension
 from markdownext import md_url, md_wikilink, md_itemprop, md_mathjax, md_strikethrough, md_tables, md_partials, md_section, md_embed
@@ -109,8 +109,6 @@ def get_cur_user():
         except oauth.OAuthRequestError:
             pass
 
-    if user is not None:
-        caching.add_recent_email(user.email())
     return user
 
 
@@ -130,8 +128,8 @@ def is_admin_user(user):
     return False
 
 
-md = markdown.Markdown(
-    extensions=[
+def markdown_extensions():
+    return [
         md_wikilink.WikiLinkExtension(),
         md_itemprop.ItemPropExtension(),
         md_url.URLExtension(),
@@ -143,7 +141,28 @@ md = markdown.Markdown(
         md_embed.EmbedExtension(),
         DefListExtension(),
         AttrListExtension(),
-    ],
-    safe_mode=False,
-    smart_emphasis=False,
-)
+    ]
+
+
+def create_markdown():
+    return markdown.Markdown(
+        extensions=markdown_extensions(),
+        safe_mode=False,
+        smart_emphasis=False,
+    )
+
+
+class MarkdownPool(threading.local):
+    """Markdown instances keep state while converting, so each thread gets its own"""
+    # identifies the output of create_markdown(). part of keys of cached html
+    context = u'%s %s' % (markdown.version, u' '.join(type(e).__name__ for e in markdown_extensions()))
+
+    def __init__(self):
+        self.instance = create_markdown()
+
+    def convert(self, text):
+        # references and stashed html of previous texts would be kept otherwise
+        return self.instance.reset().convert(text)
+
+
+md = MarkdownPool()
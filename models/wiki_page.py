@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import re
+import acl
+import json
 import yaml
+import hashlib
 import main
 import random
 import schema
@@ -8,6 +11,7 @@ import search
 import caching
 import logging
 import operator
+import itertools
 from bzrlib.merge3 import Merge3
 from collections import OrderedDict
 from google.appengine.ext import ndb
@@ -15,8 +19,8 @@ from datetime import datetime
 from google.appengine.ext import deferred
 from markdownext import md_wikilink
 
-from models import PageOperationMixin, ConflictError, WikiPageRevision, TocGenerator, SchemaDataIndex
-from models import is_admin_user, md
+from models import PageOperationMixin, PageAnalysis, ConflictError, WikiPageRevision, SchemaDataIndex, RenderedBody
+from models import is_admin_user, page_operation_mixin
 from models.utils import merge_dicts
 
 
@@ -27,6 +31,9 @@ class WikiPage(ndb.Model, PageOperationMixin):
     re_normalize_title = re.compile(ur'([\[\]\(\)\~\!\@\#\$\%\^\&\*\-'
                                     ur'\=\+\\:\;\'\"\,\.\?\<\>\s]|'
                                     ur'\bthe\b|\ban?\b)')
+    re_html_heading = re.compile(ur'<h[1-6]', re.IGNORECASE)
+    re_setext_underline = re.compile(ur'^(=+|-+)[ ]*$')
+    _legacy_pages_migrated = False
 
     itemtype_path = ndb.StringProperty()
     title = ndb.StringProperty()
@@ -47,6 +54,9 @@ class WikiPage(ndb.Model, PageOperationMixin):
     older_title = ndb.StringProperty()
     newer_title = ndb.StringProperty()
 
+    # PageAnalysis.dump() of the body: metadata and raw schema data
+    parsed = ndb.JsonProperty()
+
     @property
     def is_old_revision(self):
         return False
@@ -55,16 +65,54 @@ class WikiPage(ndb.Model, PageOperationMixin):
     def rendered_body(self):
         value = caching.get_rendered_body(self.title)
         if value is None:
-            value = super(WikiPage, self).rendered_body
-            caching.set_rendered_body(self.title, value)
+            value = caching.compute_rendered_body(self.title, self._load_rendered_body)
+        return value
+
+    def _load_rendered_body(self):
+        # pages which are not saved yet are not worth storing
+        stamp = self.render_stamp if self.revision else None
+        if stamp is not None:
+            value = RenderedBody.get_html(self.title, stamp)
+            if value is not None:
+                return value
+        value, hashbangs = self.render()
+        caching.set_hashbangs(self.title, hashbangs)
+        if stamp is not None:
+            RenderedBody.set_html(self.title, stamp, value)
         return value
 
+    @property
+    def render_stamp(self):
+        """Digest of everything rendered_body depends on"""
+        return self._render_stamp(self.analysis.body_hash)
+
+    def preview_stamp(self, preview_body):
+        """Digest of everything rendered body of get_preview_instance(preview_body) depends on"""
+        return self._render_stamp(hashlib.md5(preview_body.encode('utf-8')).hexdigest())
+
+    def _render_stamp(self, body_hash):
+        inputs = [
+            main.VERSION,
+            page_operation_mixin.RENDER_VERSION,
+            schema.get_version(),
+            self.revision,
+            self.updated_at.isoformat() if self.updated_at else None,
+            body_hash,
+            self.inlinks,
+            self.related_links,
+            self.older_title,
+            self.newer_title,
+        ]
+        return hashlib.md5(json.dumps(inputs, sort_keys=True)).hexdigest()
+
     @property
     def data(self):
         value = caching.get_data(self.title)
         if value is None:
             value = super(WikiPage, self).data
-            caching.set_data(self.title, value)
+            caching.set_data(self.title, schema.encode_data(self.itemtype, value))
+        else:
+            value = schema.decode_data(value)
         return value
 
     @property
@@ -79,8 +127,12 @@ class WikiPage(ndb.Model, PageOperationMixin):
     def hashbangs(self):
         value = caching.get_hashbangs(self.title)
         if value is None:
-            value = super(WikiPage, self).hashbangs
-            caching.set_hashbangs(self.title, value)
+            # rendering finds hashbangs as well
+            html = self.rendered_body
+            value = caching.get_hashbangs(self.title)
+            if value is None:
+                value = PageOperationMixin.extract_hashbangs(html)
+                caching.set_hashbangs(self.title, value)
         return value
 
     @property
@@ -138,6 +190,7 @@ class WikiPage(ndb.Model, PageOperationMixin):
             raise RuntimeError('Only admin can delete pages.')
 
         self.update_content('', self.revision, user=user, dont_create_rev=True, dont_defer=True)
+        acl_before = (self.acl_read, self.acl_write)
         self._update_inlinks({}, {'relatedTo': [p[0] for p in self.paths[:-1]]})
         self.related_links = {}
         self.modifier = None
@@ -146,8 +199,9 @@ class WikiPage(ndb.Model, PageOperationMixin):
         self.put()
 
         ndb.delete_multi(r.key for r in self.revisions)
+        RenderedBody.delete(self.title)
 
-        caching.del_titles()
+        WikiPage._update_title_index(self.title, acl_before, None)
 
     def update_content(self, content, base_revision, comment='', user=None, force_update=False, dont_create_rev=False, dont_defer=False, partial='all'):
         content = content.replace('\r\n', '\n')
@@ -179,10 +233,12 @@ class WikiPage(ndb.Model, PageOperationMixin):
                 return m.group(0)
 
             # replace
+            cur_index['changed'] = (m.start(), m.end())
             return u'[x]' if content == u'1' else u'[ ]'
 
         new_body = re.sub(ur'\[(\s|x)]', replacer, self.body)
-        return self._update_content_all(new_body, base_revision, comment, user, force_update, dont_create_rev, dont_defer)
+        return self._update_content_partial(new_body, cur_index.get('changed'), cur_index.get('changed'),
+                                            base_revision, comment, user, force_update, dont_create_rev, dont_defer)
 
     def _update_content_log(self, content, base_revision, comment, user, force_update, dont_create_rev, dont_defer, exp):
         cur_index = {'value': -1}
@@ -195,10 +251,122 @@ class WikiPage(ndb.Model, PageOperationMixin):
                 return m.group(0)
 
             # replace
-            return m.group(1) + content + m.group(3) + '\n' + m.group(0)
+            line = m.group(1) + content + m.group(3) + '\n'
+            cur_index['changed'] = (m.start(), m.start() + len(line))
+            return line + m.group(0)
 
         new_body = re.sub(ur'(.*)(\[__])(.*)', replacer, self.body)
-        return self._update_content_all(new_body, base_revision, comment, user, force_update, dont_create_rev, dont_defer)
+        changed = cur_index.get('changed')
+        return self._update_content_partial(new_body, changed and (changed[0], changed[0]), changed,
+                                            base_revision, comment, user, force_update, dont_create_rev, dont_defer)
+
+    def _update_content_partial(self, body, old_span, new_span, base_revision, comment, user, force_update, dont_create_rev, dont_defer):
+        """Updates body changed by a partial only in old_span of the old body, which is new_span of the new one.
+
+        A change confined to plain text cannot change metadata, headings or
+        data other than sections. Unless a changed section is a link itself,
+        it cannot change links either, so validation, merge and link updates
+        are skipped and only the changed sections are converted and indexed.
+        Any other change goes through _update_content_all.
+        """
+        def update_all():
+            return self._update_content_all(body, base_revision, comment, user, force_update, dont_create_rev, dont_defer)
+
+        if new_span is None or self.body == body or force_update or self.revision != base_revision or self.title == '.config':
+            return update_all()
+        if not WikiPage._is_plain_text(self.body, *old_span) or not WikiPage._is_plain_text(body, *new_span):
+            return update_all()
+
+        old_analysis = PageAnalysis(self.title, self.body)
+        if not old_analysis.restore(self.parsed):
+            return update_all()
+        analysis = PageAnalysis(self.title, body)
+
+        # sections are the only data the change can reach
+        old_sections = old_analysis.sections
+        new_sections = analysis.sections
+        if set(old_sections.keys()) != set(new_sections.keys()):
+            return update_all()
+        changed = [name for name, value in new_sections.items() if old_sections[name] != value]
+        old_rawdata = self.parsed['data']
+        if any(old_rawdata.get(name) != old_sections[name] for name in changed):
+            # merged with other values of the same name
+            return update_all()
+
+        itemtype = old_analysis.itemtype
+        old_data = dict((name, schema.SchemaConverter.convert_prop(itemtype, name, old_sections[name])) for name in changed)
+        new_data = dict((name, schema.SchemaConverter.convert_prop(itemtype, name, new_sections[name])) for name in changed)
+        if any(isinstance(value, schema.InvalidProperty) for value in new_data.values()):
+            return update_all()
+        if any(value.is_wikilink() for value in old_data.values() + new_data.values()):
+            # section of a Thing property links to a page named after its value
+            return update_all()
+
+        rawdata = dict(old_rawdata)
+        rawdata.update((name, new_sections[name]) for name in changed)
+        parsed = dict(self.parsed, body_hash=analysis.body_hash, data=rawdata)
+        analysis.restore(parsed)
+
+        # delete caches. metadata is not changed
+        caching.del_rendered_body(self.title)
+        caching.del_hashbangs(self.title)
+        caching.del_data(self.title)
+
+        # update model and save
+        self.body = body
+        self._analysis = analysis
+        self.parsed = parsed
+        self.modifier = user
+        self.description = analysis.description
+        self.comment = comment
+        if not dont_create_rev:
+            self.revision += 1
+        self.updated_at = datetime.now()
+        self.put()
+
+        # create revision
+        if not dont_create_rev:
+            rev_key = self._rev_key()
+            rev = WikiPageRevision(parent=rev_key, title=self.title, body=self.body,
+                                   created_at=self.updated_at, revision=self.revision,
+                                   comment=self.comment, modifier=self.modifier,
+                                   acl_read=self.acl_read, acl_write=self.acl_write)
+            rev.put()
+
+        # update schema data index of changed sections
+        if dont_defer:
+            SchemaDataIndex.update_index(self.title, old_data, new_data)
+        else:
+            deferred.defer(SchemaDataIndex.update_index, self.title, old_data, new_data)
+
+        return True
+
+    @staticmethod
+    def _is_plain_text(body, start, end):
+        """Returns True if body[start:end] is out of metadata, yaml schema block, structured data, links,
+        headings, section markers and raw html"""
+        if start < PageOperationMixin._scan_metadata(body)[1]:
+            return False
+
+        spans = itertools.chain(re.finditer(PageOperationMixin.re_yaml_schema, body),
+                                re.finditer(PageOperationMixin.re_data, body),
+                                re.finditer(md_wikilink.RE_WIKILINK, body))
+        if any(m.start() < end and start < m.end() for m in spans):
+            return False
+
+        # raw html may hold headings across lines
+        if WikiPage.re_html_heading.search(body):
+            return False
+
+        # lines of the change and a line below which may make a heading of them
+        line_start = body.rfind(u'\n', 0, start) + 1
+        below = body.find(u'\n', max(start, end - 1))
+        below = -1 if below == -1 else body.find(u'\n', below + 1)
+        lines = body[line_start:len(body) if below == -1 else below].split(u'\n')
+        return not any(line.startswith(u'#') or u'<' in line or
+                       WikiPage.re_setext_underline.match(line) or
+                       PageOperationMixin.re_section_data.match(line)
+                       for line in lines)
 
     def _update_content_all(self, body, base_revision, comment, user, force_update, dont_create_rev, dont_defer):
         # do not update if the body is not changed
@@ -208,10 +376,15 @@ class WikiPage(ndb.Model, PageOperationMixin):
         now = datetime.now()
 
         # validate and prepare new contents
-        new_data, new_md = self.validate_new_content(base_revision, body, user)
+        analysis = PageAnalysis(self.title, body)
+        new_data, new_md = self.validate_new_content(base_revision, body, user, analysis)
         new_body = self._merge_if_needed(base_revision, body)
+        if new_body != body:
+            analysis = PageAnalysis(self.title, new_body)
+
+        # get old data, metadata and acl
+        acl_before = (self.acl_read, self.acl_write) if self.updated_at else None
 
-        # get old data and metadata
         try:
             old_md = self.metadata.copy()
         except ValueError:
@@ -230,8 +403,10 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
         # update model and save
         self.body = new_body
+        self._analysis = analysis
+        self.parsed = self._dump_analysis(analysis)
         self.modifier = user
-        self.description = PageOperationMixin.make_description(new_body)
+        self.description = analysis.description
         self.acl_read = new_md.get('read', '')
         self.acl_write = new_md.get('write', '')
         self.comment = comment
@@ -259,12 +434,26 @@ class WikiPage(ndb.Model, PageOperationMixin):
         if self.title == '.config':
             caching.del_config()
 
-        # delete title cache if it's a new page
-        if self.revision == 1:
-            caching.del_titles()
+        # update title cache if it's a new page or acl is changed
+        acl_after = (self.acl_read, self.acl_write)
+        if acl_before != acl_after:
+            WikiPage._update_title_index(self.title, acl_before, acl_after)
 
         return True
 
+    def _create_analysis(self):
+        analysis = super(WikiPage, self)._create_analysis()
+        analysis.restore(self.parsed)
+        return analysis
+
+    @staticmethod
+    def _dump_analysis(analysis):
+        try:
+            return analysis.dump()
+        except ValueError:
+            # merged body is invalid. parse it again when needed
+            return None
+
     def _merge_if_needed(self, base_revision, new_body):
         if self.revision == base_revision:
             return new_body
@@ -276,9 +465,12 @@ class WikiPage(ndb.Model, PageOperationMixin):
             raise ConflictError('Conflicted', base, new_body, merged)
         return merged
 
-    def validate_new_content(self, base_revision, new_body, user):
+    def validate_new_content(self, base_revision, new_body, user, analysis=None):
+        if analysis is None:
+            analysis = PageAnalysis(self.title, new_body)
+
         # check metadata
-        new_md = PageOperationMixin.parse_metadata(new_body)
+        new_md = analysis.metadata
 
         ## prevent self-revoke
         acl_r = new_md.get('read', '')
@@ -298,7 +490,7 @@ class WikiPage(ndb.Model, PageOperationMixin):
             raise e
 
         # check data
-        new_data = PageOperationMixin.parse_data(self.title, new_body, new_md['schema'])
+        new_data = analysis.data
 
         if any(type(value) == schema.InvalidProperty for value in new_data.values()):
             invalid_keys = [key for key, value in new_data.iteritems() if type(value) == schema.InvalidProperty]
@@ -309,7 +501,7 @@ class WikiPage(ndb.Model, PageOperationMixin):
             raise ValueError('Invalid revision number: %d' % base_revision)
 
         # check headings
-        invalid_reason = TocGenerator(md.convert(new_body)).is_invalid() 
+        invalid_reason = analysis.invalid_toc_reason
         if invalid_reason:
             raise ValueError(invalid_reason)
 
@@ -335,9 +527,10 @@ class WikiPage(ndb.Model, PageOperationMixin):
         target = WikiPage.get_by_title(new_redir, follow_redirect=True) if new_redir else self
 
         updates = [source, target]
+        linking_pages = WikiPage.get_by_titles(reduce(lambda a, b: a + b, source.inlinks.values(), []))
         for rel, titles in source.inlinks.items():
             for t in titles:
-                page = WikiPage.get_by_title(t)
+                page = linking_pages[t]
                 page.del_outlink(source.title, rel)
                 page.add_outlink(target.title, rel)
                 updates.append(page)
@@ -358,8 +551,10 @@ class WikiPage(ndb.Model, PageOperationMixin):
         # 2. update inlinks
         cur_outlinks = self.outlinks
         new_outlinks = {}
-        for rel, titles in self._parse_outlinks().items():
-            new_outlinks[rel] = list({WikiPage.get_by_title(t, follow_redirect=True).title for t in titles})
+        parsed_outlinks = self._parse_outlinks()
+        targets = WikiPage.get_by_titles(reduce(lambda a, b: a + b, parsed_outlinks.values(), []), follow_redirect=True)
+        for rel, titles in parsed_outlinks.items():
+            new_outlinks[rel] = list({targets[t].title for t in titles})
 
         if self.acl_read:
             # delete all inlinks of target pages if the source page has a read restriction
@@ -387,35 +582,41 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
     def _update_inlinks(self, added_outlinks, removed_outlinks):
         # handle added links
-        updates = []
+        updates = {}
+        pages = WikiPage.get_by_titles(reduce(lambda a, b: a + list(b), added_outlinks.values(), []), follow_redirect=True)
         for rel, titles in added_outlinks.items():
             for title in titles:
-                page = WikiPage.get_by_title(title, follow_redirect=True)
+                page = pages[title]
                 page.add_inlink(self.title, rel)
-                updates.append(page)
+                updates[page.title] = page
 
         if updates:
-            ndb.put_multi(updates)
-            for page in updates:
+            ndb.put_multi(updates.values())
+            for page in updates.values():
                 caching.del_rendered_body(page.title)
                 caching.del_hashbangs(page.title)
 
         # handle removed links
-        updates = []
-        deletes = []
+        changes = {}
+        pages = WikiPage.get_by_titles(reduce(lambda a, b: a + list(b), removed_outlinks.values(), []), follow_redirect=True)
         for rel, titles in removed_outlinks.items():
             for title in titles:
-                page = WikiPage.get_by_title(title, follow_redirect=True)
+                page = pages[title]
                 page.del_inlink(self.title, rel)
-                if len(page.inlinks) == 0 and page.revision == 0 and page.key:
-                    deletes.append(page.key)
-                else:
-                    updates.append(page)
+                changes[page.title] = page
+
+        updates = []
+        deletes = []
+        for page in changes.values():
+            if len(page.inlinks) == 0 and page.revision == 0:
+                deletes.append(page)
+            else:
+                updates.append(page)
 
         if updates:
             ndb.put_multi(updates)
         if deletes:
-            ndb.delete_multi(deletes)
+            ndb.delete_multi(p.key for p in deletes)
         for page in updates + deletes:
             caching.del_rendered_body(page.title)
             caching.del_hashbangs(page.title)
@@ -554,7 +755,7 @@ class WikiPage(ndb.Model, PageOperationMixin):
         # links in hierarchical title and body
         dicts = [
             {'%s/relatedTo' % self.itemtype: [path[0] for path in self.paths[:-1]]},
-            md_wikilink.parse_wikilinks(self.itemtype, WikiPage.remove_metadata(self.body)),
+            dict((rel, list(titles)) for rel, titles in self.analysis.wikilinks.items()),
         ]
 
         # links in structured data
@@ -624,8 +825,9 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
         # evaluate
         pos, neg = parsed['pos'], parsed['neg']
-        pos_pages = [cls.get_by_title(t, True) for t in pos]
-        neg_pages = [cls.get_by_title(t, True) for t in neg]
+        pages = cls.get_by_titles(pos + neg, follow_redirect=True)
+        pos_pages = [pages[t] for t in pos]
+        neg_pages = [pages[t] for t in neg]
         scoretable = search.evaluate(
             dict((page.title, page.link_scoretable) for page in pos_pages),
             dict((page.title, page.link_scoretable) for page in neg_pages)
@@ -643,8 +845,8 @@ class WikiPage(ndb.Model, PageOperationMixin):
         if len(titles) > iteration:
             titles = random.sample(titles, iteration)
 
-        pages = [cls.get_by_title(title, follow_redirect=True) for title in titles]
-        updates = [p for p in pages if p.update_related_links()]
+        pages = cls.get_by_titles(titles, follow_redirect=True)
+        updates = [p for p in pages.values() if p.update_related_links()]
         ndb.put_multi(updates)
 
         return titles
@@ -684,7 +886,7 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
     @classmethod
     def get_index(cls, user=None):
-        q = WikiPage.query(ancestor=WikiPage._key())
+        q = WikiPage.query(ancestor=WikiPage._root_key())
 
         pages = q.order(WikiPage.title).fetch(projection=[
             WikiPage.title,
@@ -700,24 +902,82 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
     @classmethod
     def get_titles(cls, user=None):
-        email = user.email() if user is not None else u'None'
-        titles = caching.get_titles(email)
-        if titles is None:
-            titles = {page.title for page in cls.get_index(user)}
-            caching.set_titles(email, titles)
+        """Returns titles readable by the user. Do not modify returned set."""
+        # titles which anyone can read are shared by all users
+        public = caching.get_titles(u'None')
+        if public is None:
+            public = caching.compute_titles(u'None', lambda: cls._readable_titles(None))
+        if user is None:
+            return public
+
+        # each user only keeps titles of restricted pages which the user can read
+        additions = caching.get_titles(user.email())
+        if additions is None:
+            additions = caching.compute_titles(user.email(),
+                                               lambda: cls._readable_titles(user).difference(public))
+
+        return public.union(additions) if additions else public
+
+    @classmethod
+    def get_title_index(cls):
+        """Returns titles of all pages grouped by their (acl_read, acl_write)"""
+        index = caching.get_title_index()
+        if index is None:
+            index = caching.compute_title_index(cls._build_title_index)
+        return index
 
+    @classmethod
+    def reconcile_title_index(cls):
+        """Rebuilds cached title index from datastore, in case in-place updates were lost"""
+        caching.set_title_index(cls._build_title_index())
+
+    @classmethod
+    def _build_title_index(cls):
+        q = WikiPage.query(ancestor=WikiPage._root_key())
+        pages = q.fetch(projection=[
+            WikiPage.title,
+            WikiPage.acl_write,
+            WikiPage.acl_read,
+            WikiPage.updated_at])
+
+        index = {}
+        for page in pages:
+            if page.updated_at:
+                index.setdefault((page.acl_read, page.acl_write), set()).add(page.title)
+        return index
+
+    @classmethod
+    def _update_title_index(cls, title, acl_before, acl_after):
+        """Moves a title between acl groups of cached title index. None means the page does not exist"""
+        def update(index):
+            if acl_before is not None and acl_before in index:
+                index[acl_before].discard(title)
+                if len(index[acl_before]) == 0:
+                    del index[acl_before]
+            if acl_after is not None:
+                index.setdefault(acl_after, set()).add(title)
+
+        caching.update_title_index(update)
+
+    @classmethod
+    def _readable_titles(cls, user):
+        default_permission = WikiPage.get_default_permission()
+        titles = set()
+        for (acl_read, acl_write), group in cls.get_title_index().items():
+            if acl.ACL(default_permission, acl_read, acl_write).can_read(user):
+                titles.update(group)
         return titles
 
     @classmethod
     def get_posts_of(cls, title, index=0, count=50):
-        q = cls.query(ancestor=cls._key())
+        q = cls.query(ancestor=cls._root_key())
         q = q.filter(cls.published_to == title)
         q = q.filter(cls.published_at != None)
         return list(q.order(-cls.published_at).fetch(offset=index * count, limit=count))
 
     @classmethod
     def get_changes(cls, user, index=0, count=50):
-        q = WikiPage.query(ancestor=WikiPage._key())
+        q = WikiPage.query(ancestor=WikiPage._root_key())
         q = q.filter(WikiPage.updated_at != None)
 
         prjs = [
@@ -738,30 +998,42 @@ class WikiPage(ndb.Model, PageOperationMixin):
         email = user.email() if user is not None else 'None'
         results = caching.get_wikiquery(q, email)
         if results is None:
-            page_query, attrs, sort_criteria = search.parse_wikiquery(q)
-            titles = cls._evaluate_pages(page_query)
-            accessible_titles = sorted(WikiPage.get_titles(user).intersection(titles))
-
-            # evaluate
-            results = []
-            if attrs == [u'name']:
-                results += [{u'name': title} for title in accessible_titles]
-            else:
-                for title in accessible_titles:
-                    pagedata = WikiPage.get_by_title(title, follow_redirect=True).data
-                    results.append(OrderedDict((attr, pagedata[attr] if attr in pagedata else None) for attr in attrs))
+            results = caching.compute_wikiquery(q, email, lambda: cls._evaluate_wikiquery(q, user))
+        return results
 
-            # sort: only use first criterion
-            if len(sort_criteria) > 0:
-                criterion = sort_criteria[0][0]
-                descending = sort_criteria[0][1] == '-'
-                results = sorted(results, key=lambda r: r[criterion].pvalue, reverse=descending)
+    @classmethod
+    def _evaluate_wikiquery(cls, q, user):
+        """Returns results and generations of index terms, titles and page data they depend on"""
+        page_query, attrs, sort_criteria = search.parse_wikiquery(q)
 
-            if len(results) == 1:
-                results = results[0]
+        # generations are taken before reading what they cover
+        generations = [caching.get_wikiquery_generations(terms=cls._page_query_terms(page_query),
+                                                         namespaces=['title_sets'])]
+        titles = cls._evaluate_pages(page_query)
+        accessible_titles = sorted(WikiPage.get_titles(user).intersection(titles))
 
-            caching.set_wikiquery(q, email, results)
-        return results
+        # evaluate
+        results = []
+        if attrs == [u'name']:
+            results += [{u'name': title} for title in accessible_titles]
+        else:
+            generations.append(caching.get_wikiquery_generations(titles=accessible_titles))
+            pages = WikiPage.get_by_titles(accessible_titles, follow_redirect=True)
+            redirected = [page.title for title, page in pages.items() if page.title != title]
+            generations.append(caching.get_wikiquery_generations(titles=redirected))
+            for title in accessible_titles:
+                pagedata = pages[title].data
+                results.append(OrderedDict((attr, pagedata[attr] if attr in pagedata else None) for attr in attrs))
+
+        # sort: only use first criterion
+        if len(sort_criteria) > 0:
+            criterion = sort_criteria[0][0]
+            descending = sort_criteria[0][1] == '-'
+            results = sorted(results, key=lambda r: r[criterion].pvalue, reverse=descending)
+
+        if len(results) == 1:
+            results = results[0]
+        return results, generations
 
     @classmethod
     def _evaluate_pages(cls, q):
@@ -775,9 +1047,23 @@ class WikiPage(ndb.Model, PageOperationMixin):
 
     @classmethod
     def _evaluate_page_query_term(cls, name, value):
+        return SchemaDataIndex.query_titles(*cls._normalize_page_query_term(name, value))
+
+    @classmethod
+    def _normalize_page_query_term(cls, name, value):
         if name == 'schema' and value.find('/') == -1:
             value = schema.get_itemtype_path(value)
-        return SchemaDataIndex.query_titles(name, value)
+        return name, value
+
+    @classmethod
+    def _page_query_terms(cls, q):
+        """Returns (name, value) index terms used in a page query"""
+        if len(q) == 1:
+            return cls._page_query_terms(q[0])
+        elif len(q) == 2:
+            return [cls._normalize_page_query_term(q[0], q[1])]
+        else:
+            return cls._page_query_terms(q[0]) + cls._page_query_terms(q[2:])
 
     @classmethod
     def _evaluate_page_query_expr(cls, operand, op, rest):
@@ -801,16 +1087,145 @@ class WikiPage(ndb.Model, PageOperationMixin):
         if title[0] == u'=':
             raise ValueError(u'WikiPage title cannot starts with "="')
 
-        key = cls._key()
-        page = WikiPage.query(WikiPage.title == title, ancestor=key).get()
+        key = cls._title_key(title)
+        page = key.get() or cls._get_legacy_by_title(title)
         if page is None:
-            page = WikiPage(parent=key, title=title, body=u'', revision=0,
-                            inlinks={}, outlinks={}, related_links={})
+            page = cls._new_page(title)
         elif follow_redirect:
             page = cls._follow_redirect(page)
 
         return page
 
+    @classmethod
+    def get_by_titles(cls, titles, follow_redirect=False):
+        """Returns a dict of pages keyed by requested titles, fetched in batch"""
+        titles = list(set(titles))
+        if any(title[0] == u'=' for title in titles):
+            raise ValueError(u'WikiPage title cannot starts with "="')
+
+        pages = cls._get_multi_by_titles(titles)
+        if follow_redirect:
+            cls._follow_redirects(pages)
+        return pages
+
+    @classmethod
+    def _get_multi_by_titles(cls, titles):
+        pages = dict(zip(titles, ndb.get_multi([cls._title_key(t) for t in titles])))
+
+        missings = [t for t, page in pages.items() if page is None]
+        if missings and cls._has_legacy_pages():
+            futures = [(t, WikiPage.query(WikiPage.title == t, ancestor=cls._root_key()).get_async())
+                       for t in missings]
+            for t, future in futures:
+                page = future.get_result()
+                if page is not None:
+                    pages[t] = cls._migrate_to_title_key(page)
+
+        for t, page in pages.items():
+            if page is None:
+                pages[t] = cls._new_page(t)
+        return pages
+
+    @classmethod
+    def _follow_redirects(cls, pages):
+        """Replace pages in-place with their redirect targets, resolving one hop per batch"""
+        trails = dict((t, {page.title}) for t, page in pages.items())
+        resolved = dict((page.title, page) for page in pages.values())
+        pending = [t for t, page in pages.items() if 'redirect' in cls._parsed_metadata(page)]
+
+        while pending:
+            next_titles = dict((t, cls._parsed_metadata(pages[t])['redirect']) for t in pending)
+            for t, next_title in next_titles.items():
+                if next_title in trails[t]:
+                    raise ValueError('Circular redirection detected')
+                trails[t].add(next_title)
+
+            fetches = list(set(next_titles.values()).difference(resolved.keys()))
+            resolved.update(cls._get_multi_by_titles(fetches))
+
+            for t, next_title in next_titles.items():
+                pages[t] = resolved[next_title]
+            pending = [t for t in pending if 'redirect' in cls._parsed_metadata(pages[t])]
+
+    @staticmethod
+    def _parsed_metadata(page):
+        # metadata stored on the entity, without a memcache round trip per page
+        return page.analysis.metadata
+
+    @classmethod
+    def _new_page(cls, title):
+        return WikiPage(key=cls._title_key(title), title=title, body=u'', revision=0,
+                        inlinks={}, outlinks={}, related_links={})
+
+    @classmethod
+    def _get_legacy_by_title(cls, title):
+        """Find a page stored with an auto-allocated id and move it under its title key"""
+        if not cls._has_legacy_pages():
+            return None
+
+        page = WikiPage.query(WikiPage.title == title, ancestor=cls._root_key()).get()
+        if page is None:
+            return None
+        return cls._migrate_to_title_key(page)
+
+    @classmethod
+    def _has_legacy_pages(cls):
+        # new pages are always keyed by title, so once none is left it stays so
+        if cls._legacy_pages_migrated:
+            return False
+
+        # auto-allocated (integer) ids are ordered before title (string) ids
+        q = WikiPage.query(ancestor=cls._root_key()).order(WikiPage._key)
+        first = q.get(keys_only=True)
+        if first is None or first.integer_id() is None:
+            WikiPage._legacy_pages_migrated = True
+            return False
+        return True
+
+    @classmethod
+    def _migrate_to_title_key(cls, page):
+        """Moves a legacy page under its title key. Returns None if the page is deleted meanwhile"""
+        if page.key.id() == page.title:
+            return page
+
+        # both keys are in the same entity group, so a concurrent update of
+        # the legacy page or another migration of it cannot be lost
+        legacy_key = page.key
+
+        def migrate():
+            key = cls._title_key(page.title)
+            migrated = key.get()
+            if migrated is not None:
+                # a duplicate of a page already migrated or created meanwhile.
+                # revisions are kept by title, so only the entity is dropped
+                if legacy_key.get() is not None:
+                    logging.warning(u'Dropping duplicate legacy page %s' % page.title)
+                    legacy_key.delete()
+                return migrated
+            legacy = legacy_key.get()
+            if legacy is None:
+                return None
+            migrated = WikiPage(key=key, **legacy.to_dict())
+            migrated.put()
+            legacy_key.delete()
+            return migrated
+        return ndb.transaction(migrate)
+
+    @classmethod
+    def migrate_all_to_title_keys(cls):
+        logging.debug('Migrating page keys')
+
+        batch_size = 50
+        q = WikiPage.query(ancestor=cls._root_key()).order(WikiPage._key)
+        legacy_pages = [p for p in q.fetch(batch_size) if p.key.integer_id() is not None]
+        if len(legacy_pages) == 0:
+            WikiPage._legacy_pages_migrated = True
+            logging.debug('Migrating page keys: Finished!')
+            return
+
+        [cls._migrate_to_title_key(p) for p in legacy_pages]
+        deferred.defer(cls.migrate_all_to_title_keys)
+
     @classmethod
     def _follow_redirect(cls, page, new_redir=None):
         trail = {page.title}
@@ -865,9 +1280,13 @@ class WikiPage(ndb.Model, PageOperationMixin):
         return re.sub(cls.re_normalize_title, u'', title.lower())
 
     @classmethod
-    def _key(cls):
+    def _root_key(cls):
         return ndb.Key(u'wiki', u'/')
 
+    @classmethod
+    def _title_key(cls, title):
+        return ndb.Key(WikiPage, title, parent=cls._root_key())
+
     @classmethod
     def rebuild_all_data_index(cls, page_index=0):
         logging.debug('Rebuilding data index: %d' % page_index)
@@ -155,6 +155,7 @@ class PageResource(PageLikeResource):
         if (not page.can_write(self.user)) and self.req.GET.get('view', self.default_view) == 'edit':
             self._403(page, head)
             return
+        caching.prefetch_page(page.title)
 
         if get_restype(self.req, 'html') == 'html' and self.req.GET.get('view', self.default_view) == 'default':
             redirect = page.metadata.get('redirect', None)
@@ -218,10 +219,14 @@ class PageResource(PageLikeResource):
 
         if preview == '1':
             self.res.headers['Content-Type'] = 'text/html; charset=utf-8'
-            page = page.get_preview_instance(new_body)
-            html = template(self.req, 'wikipage_bodyonly.html', {
-                'page': page,
-            })
+            # editors send the same body again and again
+            stamp = page.preview_stamp(new_body)
+            html = caching.get_preview(page.title, stamp)
+            if html is None:
+                html = template(self.req, 'wikipage_bodyonly.html', {
+                    'page': page.get_preview_instance(new_body),
+                })
+                caching.set_preview(page.title, stamp, html)
             set_response_body(self.res, html, False)
             return
 
@@ -628,6 +633,8 @@ def render_atom(req, title, path, pages, include_content=False, use_published_da
     title = '%s: %s' % (config['service']['title'], title)
     url = "%s/%s?_type=atom" % (host, path)
     feed = AtomFeed(title=title, feed_url=url, url="%s/" % host, author=config['admin']['email'])
+    if include_content:
+        caching.prefetch_pages([page.title for page in pages])
     for page in pages:
         feed.add(title=page.title,
                  content_type="html",
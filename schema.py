@@ -4,8 +4,9 @@ import os
 import re
 import sys
 import json
-import caching
+import hashlib
 import operator
+import threading
 from datetime import date, datetime
 from markdownext import md_wikilink
 
@@ -17,35 +18,276 @@ SCHEMA_TO_LOAD = [
 ]
 
 
-def get_schema_set():
-    schema_set = caching.get_schema_set()
-    if schema_set is not None:
-        return schema_set
+_registry_lock = threading.Lock()
+_registry = None
 
-    for s in SCHEMA_TO_LOAD:
-        if type(s) == dict:
-            new_schema = s
-        else:
-            fullpath = os.path.join(os.path.dirname(__file__), s)
+
+class SchemaRegistry(object):
+    """Merged and fully resolved schema, built once per process.
+
+    The merged set is too big to fit in a single memcache value, so it is
+    kept in instance memory and reloaded only when SCHEMA_TO_LOAD changes.
+    Every type, property and datatype is resolved up front (inherited
+    properties, ancestors, cardinalities, conversion order of ranges), so
+    accessors below are plain dict lookups. Returned dicts are shared
+    between requests and must not be modified.
+    """
+    def __init__(self, sources):
+        self.sources = sources
+        self.schema_set = None
+        for s in sources:
+            if type(s) == dict:
+                new_schema = s
+            else:
+                new_schema = _load_schema_file(s)
+            self.schema_set = _merge_schema_set(new_schema, self.schema_set)
+
+            if 'ui' not in self.schema_set:
+                self.schema_set['ui'] = {'selectableTypes': []}
+
+        props = self.schema_set['properties']
+        self.legacy_spellings = frozenset(
+            pname for pname, pdata in props.items()
+            if 'comment' in pdata and pdata['comment'].find('(legacy spelling;') != -1
+        )
+
+        self.properties = dict(
+            (pname, self._compile_property(pname, pdata))
+            for pname, pdata in props.items()
+            if pname not in self.legacy_spellings
+        )
+        self.datatypes = dict(
+            (tname, self._compile_datatype(tname, tdata))
+            for tname, tdata in self.schema_set['datatypes'].items()
+        )
+
+        self.types = {}
+        for itemtype in self.schema_set['types'].keys():
             try:
-                with open(fullpath) as f:
-                    new_schema = json.load(f)
-            except IOError:
-                new_schema = {}
+                self._compile_type(itemtype)
+            except KeyError:
+                # broken custom type: leave it unresolved so that lookups fail
+                pass
+
+        self.itemtype_paths = dict((t, self._compile_itemtype_path(t)) for t in self.types.keys())
+        self.cardinalities = {}
+        for itemtype in self.types.keys():
+            try:
+                self.cardinalities[itemtype] = self._compile_cardinalities(itemtype)
+            except KeyError:
+                # type refers to an unknown property: leave it unresolved
+                pass
+        self.known_properties = dict(
+            (t, frozenset(item['properties'] + item['specific_properties'] + ['schema']))
+            for t, item in self.types.items()
+        )
+        self.itemtypes = sorted(
+            [(k, v['label']) for k, v in self.types.items()],
+            key=operator.itemgetter(0)
+        )
+        self._selectable_itemtypes = None
+        self._range_types = {}
+        self._converters = {}
+        self._version = None
+
+    @property
+    def version(self):
+        """Digest of the merged schema set. Changes whenever any schema source changes."""
+        if self._version is None:
+            self._version = hashlib.md5(json.dumps(self.schema_set, sort_keys=True)).hexdigest()
+        return self._version
+
+    @property
+    def selectable_itemtypes(self):
+        if self._selectable_itemtypes is None:
+            selectable_itemtypes = self.schema_set['ui']['selectableTypes']
+
+            if len(selectable_itemtypes):
+                self._selectable_itemtypes = [(k, self.types[k]['label']) for k in selectable_itemtypes]
+            else:
+                self._selectable_itemtypes = self.itemtypes
+        return self._selectable_itemtypes
+
+    def range_types(self, prop_name):
+        """Returns (type_obj, ptype) pairs of the property's ranges in conversion order"""
+        types = self._range_types.get(prop_name)
+        if types is None:
+            ranges = get_property(prop_name)['ranges']
+            types = [(SchemaConverter.type_by_name(ptype), ptype) for ptype in ranges]
+            types = sorted(types, key=lambda t: PRIORITY[t[0]])
+            self._range_types[prop_name] = types
+        return types
+
+    def converter(self, prop_name):
+        """Returns precompiled PropertyConverter of the property"""
+        converter = self._converters.get(prop_name)
+        if converter is None:
+            converter = PropertyConverter(self, prop_name)
+            self._converters[prop_name] = converter
+        return converter
+
+    def _compile_type(self, itemtype):
+        if itemtype in self.types:
+            return self.types[itemtype]
+
+        item = dict(self.schema_set['types'][itemtype])
+
+        # populate missing fields
+        if 'url' not in item:
+            item['url'] = '/sp.schema/types/%s' % itemtype
+        if 'id' not in item:
+            item['id'] = itemtype
+        if 'label' not in item:
+            item['label'] = item['id']
+        if 'comment' not in item:
+            item['comment'] = item['label']
+        if 'comment_plain' not in item:
+            item['comment_plain'] = item['comment']
+        if 'subtypes' not in item:
+            item['subtypes'] = []
+        if 'ancestors' not in item:
+            # collect ancestors
+            ancestors = []
+            parent = item
+            while len(parent['supertypes']) > 0:
+                parent_itemtype = parent['supertypes'][0]
+                ancestors.append(parent_itemtype)
+                parent = self._compile_type(parent_itemtype)
+            ancestors.reverse()
+            item['ancestors'] = ancestors
+        if 'plural_label' not in item:
+            if item['label'][-2:] in ['ay', 'ey', 'iy', 'oy', 'uy', 'wy']:
+                item['plural_label'] = u'%ss' % item['label']
+            elif item['label'].endswith('y'):
+                item['plural_label'] = u'%sies' % item['label'][:-1]
+            elif item['label'].endswith('s') or item['label'].endswith('o'):
+                item['plural_label'] = u'%ses' % item['label']
+            else:
+                item['plural_label'] = u'%ss' % item['label']
 
-        schema_set = _merge_schema_set(new_schema, schema_set)
+        # inherit properties of supertypes
+        properties = list(item.get('properties', []))
+        for stype in item['supertypes']:
+            properties += [p for p in self._compile_type(stype)['properties'] if p not in properties]
 
-        if 'ui' not in schema_set:
-            schema_set['ui'] = {'selectableTypes': []}
+        # remove legacy spellings
+        properties = [p for p in properties if p not in self.legacy_spellings]
+        sprops = [p for p in item['specific_properties'] if p not in self.legacy_spellings]
 
-    caching.set_schema_set(schema_set)
-    return schema_set
+        # merge specific_properties into properties
+        properties += [p for p in sprops if p not in properties]
+        item['properties'] = properties
+        item['specific_properties'] = sprops
+
+        self.types[itemtype] = item
+        return item
+
+    def _compile_datatype(self, type_name, dtype):
+        dtype = dict(dtype)
+
+        # populate missing fields
+        if 'url' not in dtype:
+            dtype['url'] = '/sp.schema/datatypes/%s' % type_name
+        if 'properties' not in dtype:
+            dtype['properties'] = []
+        if 'specific_properties' not in dtype:
+            dtype['specific_properties'] = []
+        if 'supertypes' not in dtype:
+            dtype['supertypes'] = ['DataType']
+        if 'subtypes' not in dtype:
+            dtype['subtypes'] = []
+        if 'id' not in dtype:
+            dtype['id'] = type_name
+        if 'label' not in dtype:
+            dtype['label'] = dtype['id']
+        if 'comment' not in dtype:
+            dtype['comment'] = dtype['label']
+        if 'comment_plain' not in dtype:
+            dtype['comment_plain'] = dtype['comment']
+        if 'ancestors' not in dtype:
+            dtype['ancestors'] = dtype['supertypes']
+        return dtype
+
+    def _compile_property(self, prop_name, prop):
+        prop = dict(prop)
+
+        # populate missing fields
+        if 'domains' not in prop:
+            prop['domains'] = ['Thing']
+        if 'ranges' not in prop:
+            prop['ranges'] = ['Text']
+        if 'id' not in prop:
+            prop['id'] = prop_name
+        if 'label' not in prop:
+            prop['label'] = prop['id']
+        if 'comment' not in prop:
+            prop['comment'] = prop['label']
+        if 'comment_plain' not in prop:
+            prop['comment_plain'] = prop['comment']
+        if 'reversed_label' not in prop:
+            prop['reversed_label'] = '[%%s] %s' % prop['label']
+        return prop
+
+    def _compile_itemtype_path(self, itemtype):
+        try:
+            parts = []
+            parent = itemtype
+            while parent is not None:
+                parts.append(parent)
+                supers = self.types[parent]['supertypes']
+                parent = supers[0] if len(supers) > 0 else None
+            parts.reverse()
+            parts.append('')
+            return '/'.join(parts)
+        except KeyError:
+            return None
+
+    def _compile_cardinalities(self, itemtype):
+        item_cardinalities = self.types[itemtype].get('cardinalities', {})
+        result = {}
+        for pname in self.types[itemtype]['properties']:
+            if pname in item_cardinalities:
+                result[pname] = item_cardinalities[pname]
+            else:
+                result[pname] = self._property_cardinality(pname)
+        return result
+
+    def _property_cardinality(self, prop_name):
+        prop = self.properties[prop_name]
+        return prop['cardinality'] if 'cardinality' in prop else [0, 0]
+
+
+def get_registry():
+    global _registry
+    registry = _registry
+    if registry is not None and registry.sources == SCHEMA_TO_LOAD:
+        return registry
+
+    with _registry_lock:
+        if _registry is None or _registry.sources != SCHEMA_TO_LOAD:
+            _registry = SchemaRegistry(list(SCHEMA_TO_LOAD))
+        return _registry
+
+
+def get_schema_set():
+    return get_registry().schema_set
+
+
+def _load_schema_file(filename):
+    fullpath = os.path.join(os.path.dirname(__file__), filename)
+    try:
+        with open(fullpath) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def get_version():
+    return get_registry().version
 
 
 def get_legacy_spellings():
-    schema_set = get_schema_set()
-    props = schema_set['properties']
-    return {pname for pname, pdata in props.items() if 'comment' in pdata and pdata['comment'].find('(legacy spelling;') != -1}
+    return get_registry().legacy_spellings
 
 
 def get_sc_schema(itemtype):
@@ -69,184 +311,40 @@ def get_sc_schema(itemtype):
 def get_schema(itemtype, self_contained=False):
     if self_contained:
         return get_sc_schema(itemtype)
-
-    item = caching.get_schema(itemtype)
-    if item is not None:
-        return item
-
-    item = get_schema_set()['types'][itemtype]
-
-    # populate missing fields
-    if 'url' not in item:
-        item['url'] = '/sp.schema/types/%s' % itemtype
-    if 'id' not in item:
-        item['id'] = itemtype
-    if 'label' not in item:
-        item['label'] = item['id']
-    if 'comment' not in item:
-        item['comment'] = item['label']
-    if 'comment_plain' not in item:
-        item['comment_plain'] = item['comment']
-    if 'subtypes' not in item:
-        item['subtypes'] = []
-    if 'ancestors' not in item:
-        # collect ancestors
-        ancestors = []
-        parent = item
-        while len(parent['supertypes']) > 0:
-            parent_itemtype = parent['supertypes'][0]
-            ancestors.append(parent_itemtype)
-            parent = get_schema(parent_itemtype)
-        ancestors.reverse()
-        item['ancestors'] = ancestors
-    if 'plural_label' not in item:
-        if item['label'][-2:] in ['ay', 'ey', 'iy', 'oy', 'uy', 'wy']:
-            item['plural_label'] = u'%ss' % item['label']
-        elif item['label'].endswith('y'):
-            item['plural_label'] = u'%sies' % item['label'][:-1]
-        elif item['label'].endswith('s') or item['label'].endswith('o'):
-            item['plural_label'] = u'%ses' % item['label']
-        else:
-            item['plural_label'] = u'%ss' % item['label']
-
-    # inherit properties of supertypes
-    if 'properties' not in item:
-        item['properties'] = []
-
-    for stype in item['supertypes']:
-        super_props = [p for p in get_schema(stype)['properties'] if p not in item['properties']]
-        item['properties'] += super_props
-
-    # remove legacy spellings
-    legacy_spellings = set(get_legacy_spellings())
-
-    item['properties'] = [p for p in item['properties'] if p not in legacy_spellings]
-    sprops = [p for p in item['specific_properties'] if p not in legacy_spellings]
-
-    # merge specific_properties into properties and sort
-    item['properties'] += [p for p in sprops if p not in item['properties']]
-    item['specific_properties'] = sprops
-
-    caching.set_schema(itemtype, item)
-    return item
+    return get_registry().types[itemtype]
 
 
 def get_itemtypes():
-    itemtypes = caching.get_schema_itemtypes()
-    if itemtypes is not None:
-        return itemtypes
-
-    itemtypes = sorted(
-        [(k, v['label']) for k, v in get_schema_set()['types'].items()],
-        key=operator.itemgetter(0)
-    )
-
-    caching.set_schema_itemtypes(itemtypes)
-    return itemtypes
+    return get_registry().itemtypes
 
 
 def get_selectable_itemtypes():
-    itemtypes = caching.get_schema_selectable_itemtypes()
-    if itemtypes is not None:
-        return itemtypes
-
-    all_itemtypes = get_schema_set()['types']
-    selectable_itemtypes = get_schema_set()['ui']['selectableTypes']
-
-    if len(selectable_itemtypes):
-        itemtypes = [(k, all_itemtypes[k]['label']) for k in selectable_itemtypes]
-    else:
-        itemtypes = sorted(
-            [(k, v['label']) for k, v in all_itemtypes.items()],
-            key=operator.itemgetter(0)
-        )
-
-    caching.set_schema_selectable_itemtypes(itemtypes)
-    return itemtypes
+    return get_registry().selectable_itemtypes
 
 
 def get_datatype(type_name):
-    dtype = caching.get_schema_datatype(type_name)
-    if dtype is not None:
-        return dtype
-
-    dtype = get_schema_set()['datatypes'][type_name]
-
-    # populate missing fields
-    if 'url' not in dtype:
-        dtype['url'] = '/sp.schema/datatypes/%s' % type_name
-    if 'properties' not in dtype:
-        dtype['properties'] = []
-    if 'specific_properties' not in dtype:
-        dtype['specific_properties'] = []
-    if 'supertypes' not in dtype:
-        dtype['supertypes'] = ['DataType']
-    if 'subtypes' not in dtype:
-        dtype['subtypes'] = []
-    if 'id' not in dtype:
-        dtype['id'] = type_name
-    if 'label' not in dtype:
-        dtype['label'] = dtype['id']
-    if 'comment' not in dtype:
-        dtype['comment'] = dtype['label']
-    if 'comment_plain' not in dtype:
-        dtype['comment_plain'] = dtype['comment']
-    if 'ancestors' not in dtype:
-        dtype['ancestors'] = dtype['supertypes']
-
-    caching.set_schema_datatype(type_name, dtype)
-    return dtype
+    return get_registry().datatypes[type_name]
 
 
 def get_property(prop_name):
-    if prop_name in get_legacy_spellings():
+    registry = get_registry()
+    if prop_name in registry.legacy_spellings:
         raise KeyError('Legacy spelling: %s' % prop_name)
-
-    prop = caching.get_schema_property(prop_name)
-    if prop is not None:
-        return prop
-
-    prop = get_schema_set()['properties'][prop_name]
-
-    # populate missing fields
-    if 'domains' not in prop:
-        prop['domains'] = ['Thing']
-    if 'ranges' not in prop:
-        prop['ranges'] = ['Text']
-    if 'id' not in prop:
-        prop['id'] = prop_name
-    if 'label' not in prop:
-        prop['label'] = prop['id']
-    if 'comment' not in prop:
-        prop['comment'] = prop['label']
-    if 'comment_plain' not in prop:
-        prop['comment_plain'] = prop['comment']
-    if 'reversed_label' not in prop:
-        prop['reversed_label'] = '[%%s] %s' % prop['label']
-
-    caching.set_schema_property(prop_name, prop)
-    return prop
+    return registry.properties[prop_name]
 
 
 def get_cardinality(itemtype, prop_name):
+    registry = get_registry()
     try:
-        item = get_schema(itemtype)
-        return item['cardinalities'][prop_name]
+        return registry.types[itemtype]['cardinalities'][prop_name]
     except KeyError:
-        prop = get_property(prop_name)
-        return prop['cardinality'] if 'cardinality' in prop else [0, 0]
+        if prop_name in registry.legacy_spellings:
+            raise KeyError('Legacy spelling: %s' % prop_name)
+        return registry._property_cardinality(prop_name)
 
 
 def get_cardinalities(itemtype):
-    result = caching.get_cardinalities(itemtype)
-    if result is not None:
-        return result
-
-    properties = get_schema(itemtype)['properties']
-    properties_dict = dict([(pname, get_cardinality(itemtype, pname)) for pname in properties])
-
-    caching.set_cardinalities(itemtype, properties_dict)
-    return properties_dict
+    return get_registry().cardinalities[itemtype]
 
 
 def humane_item(itemtype, plural=False):
@@ -272,18 +370,10 @@ def humane_property(itemtype, prop, rev=False):
 
 
 def get_itemtype_path(itemtype):
-    try:
-        parts = []
-        parent = itemtype
-        while parent is not None:
-            parts.append(parent)
-            supers = get_schema(parent)['supertypes']
-            parent = supers[0] if len(supers) > 0 else None
-        parts.reverse()
-        parts.append('')
-        return '/'.join(parts)
-    except KeyError:
+    path = get_registry().itemtype_paths.get(itemtype)
+    if path is None:
         raise ValueError('Unsupported schema: %s' % itemtype)
+    return path
 
 
 def _merge_schema_set(addon, schema_set):
@@ -370,7 +460,7 @@ class SchemaConverter(object):
             raise ValueError('Unknown itemtype: %s' % self._itemtype)
 
         props = set(self._data.keys())
-        unknown_props = props.difference(schema_item['properties'] + schema_item['specific_properties'] + ['schema'])
+        unknown_props = props.difference(get_registry().known_properties[self._itemtype])
         known_props = props.difference(unknown_props)
 
         self.check_cardinality()
@@ -413,21 +503,7 @@ class SchemaConverter(object):
         if pname == 'schema':
             return TextProperty(itemtype, 'Text', pname, pvalue)
 
-        prop = get_property(pname)
-        if 'enum' in prop and pvalue not in prop['enum']:
-            return InvalidProperty(itemtype, 'Invalid', pname, pvalue)
-
-        ranges = prop['ranges']
-        types = [(SchemaConverter.type_by_name(ptype), ptype) for ptype in ranges]
-        types = [(type_obj, ptype, PRIORITY[type_obj]) for type_obj, ptype in types]
-        sorted_types = sorted(types, key=operator.itemgetter(2))
-
-        for type_obj, ptype, _ in sorted_types:
-            try:
-                return type_obj(itemtype, ptype, pname, pvalue)
-            except ValueError:
-                pass
-        return InvalidProperty(itemtype, 'Invalid', pname, pvalue)
+        return get_registry().converter(pname).convert(itemtype, pvalue)
 
     @staticmethod
     def type_by_name(name):
@@ -437,6 +513,48 @@ class SchemaConverter(object):
             return ThingProperty
 
 
+class PropertyConverter(object):
+    """Conversion chain of a property, compiled once per schema registry.
+
+    Ranges which can never be constructed (unknown itemtypes or datatypes)
+    are dropped, and each remaining range gets a cheap pre-check so that
+    values which would be rejected by its constructor are skipped without
+    raising. Pre-checks are necessary conditions only: the constructor
+    still has the last word.
+    """
+    def __init__(self, registry, pname):
+        self.pname = pname
+        prop = get_property(pname)
+        self.enum = prop['enum'] if 'enum' in prop else None
+        self.chain = [
+            (type_obj, ptype, PRECHECKS.get(type_obj))
+            for type_obj, ptype in registry.range_types(pname)
+            if self._is_constructible(registry, type_obj, ptype)
+        ]
+
+    @staticmethod
+    def _is_constructible(registry, type_obj, ptype):
+        if type_obj is ThingProperty:
+            return ptype in registry.types
+        elif issubclass(type_obj, TypeProperty) and type_obj is not DateTimeProperty:
+            return ptype in registry.datatypes
+        else:
+            return True
+
+    def convert(self, itemtype, pvalue):
+        if self.enum is not None and pvalue not in self.enum:
+            return InvalidProperty(itemtype, 'Invalid', self.pname, pvalue)
+
+        for type_obj, ptype, precheck in self.chain:
+            if precheck is not None and not precheck(pvalue):
+                continue
+            try:
+                return type_obj(itemtype, ptype, self.pname, pvalue)
+            except ValueError:
+                pass
+        return InvalidProperty(itemtype, 'Invalid', self.pname, pvalue)
+
+
 class Property(object):
     def __init__(self, itemtype, ptype, pname, pvalue):
         self.itemtype = itemtype
@@ -490,7 +608,7 @@ class ThingProperty(Property):
 class TypeProperty(Property):
     def __init__(self, itemtype, ptype, pname, pvalue):
         super(TypeProperty, self).__init__(itemtype, ptype, pname, pvalue)
-        if ptype not in get_schema_set()['datatypes']:
+        if ptype not in get_registry().datatypes:
             raise ValueError('Unknown datatype: %s' % ptype)
 
 
@@ -709,3 +827,149 @@ PRIORITY = {
 
     Property: 8,
 }
+
+
+def _precheck_pattern(pattern, flags=0):
+    regex = re.compile(pattern, flags)
+    return lambda pvalue: not isinstance(pvalue, basestring) or regex.match(pvalue) is not None
+
+
+def _precheck_boolean(pvalue):
+    return not isinstance(pvalue, basestring) or pvalue.lower() in ('1', 'yes', 'true', '0', 'no', 'false')
+
+
+# int() takes spaces after the sign and float() takes inf and nan
+_precheck_number = _precheck_pattern(ur'\s*[-+]?\s*(\.?\d|inf|nan)', re.UNICODE | re.IGNORECASE)
+_precheck_integer = _precheck_pattern(ur'\s*[-+]?\d+\s*$', re.UNICODE)
+
+PRECHECKS = {
+    ISBNProperty: _precheck_pattern(ISBNProperty.P_ISBN),
+    EmbeddableURLProperty: _precheck_pattern(URLProperty.P_URL),
+    URLProperty: _precheck_pattern(URLProperty.P_URL),
+    DateProperty: _precheck_pattern(DateProperty.P_DATE),
+    BooleanProperty: _precheck_boolean,
+    IntegerProperty: _precheck_integer,
+    FloatProperty: _precheck_number,
+    NumberProperty: _precheck_number,
+}
+
+
+# type codes of compactly encoded data. append only; codes are kept in caches
+PROPERTY_TYPES = [
+    Property,
+    InvalidProperty,
+    ThingProperty,
+    TypeProperty,
+    BooleanProperty,
+    TextProperty,
+    LongTextProperty,
+    NumberProperty,
+    IntegerProperty,
+    FloatProperty,
+    DateTimeProperty,
+    TimeProperty,
+    URLProperty,
+    EmbeddableURLProperty,
+    DateProperty,
+    ISBNProperty,
+]
+_TYPE_CODES = dict((t, code) for code, t in enumerate(PROPERTY_TYPES))
+_RAW = -1
+
+
+def encode_data(itemtype, data):
+    """Returns typed data in a compact form for caching.
+
+    Each distinct (type code, ptype, itemtype) is stored once in a table, and
+    values refer to it by slot: (slot, pvalue) for a single value and
+    [slot, pvalue, ...] for a list of values sharing a slot. Lists with mixed
+    slots are stored as [None, (slot, pvalue), ...]. Values which are not
+    properties use slot -1.
+    """
+    slots = {}
+    values = dict((pname, _encode_value(slots, value)) for pname, value in data.items())
+    table = [None] * len(slots)
+    for key, slot in slots.items():
+        table[slot] = key
+    return itemtype, table, values
+
+
+def decode_data(encoded):
+    """Returns data encoded by encode_data. Properties are rehydrated on first access."""
+    if isinstance(encoded, dict):
+        # cached before compact encoding was introduced
+        return encoded
+    return LazyData(*encoded)
+
+
+def _encode_value(slots, value):
+    if type(value) == list:
+        encoded = [_encode_value(slots, v) for v in value]
+        shared = set(e[0] for e in encoded)
+        if len(shared) == 1 and _RAW not in shared:
+            return [encoded[0][0]] + [e[1] for e in encoded]
+        return [None] + encoded
+    elif type(value) in _TYPE_CODES:
+        key = (_TYPE_CODES[type(value)], value.ptype, value.itemtype)
+        return slots.setdefault(key, len(slots)), value.pvalue
+    else:
+        return _RAW, value
+
+
+def _decode_value(table, pname, encoded):
+    if type(encoded) == list:
+        if encoded[0] is None:
+            return [_decode_value(table, pname, e) for e in encoded[1:]]
+        return [_decode_property(table[encoded[0]], pname, pvalue) for pvalue in encoded[1:]]
+    elif encoded[0] == _RAW:
+        return encoded[1]
+    return _decode_property(table[encoded[0]], pname, encoded[1])
+
+
+def _decode_property(key, pname, pvalue):
+    code, ptype, itemtype = key
+    try:
+        return PROPERTY_TYPES[code](itemtype, ptype, pname, pvalue)
+    except ValueError:
+        # schema has changed since it was cached
+        return InvalidProperty(itemtype, 'Invalid', pname, pvalue)
+
+
+class LazyData(collections.MutableMapping):
+    """Typed data which rehydrates each property from its compact encoding on first access"""
+    def __init__(self, itemtype, table, encoded):
+        self.itemtype = itemtype
+        self._table = table
+        self._values = dict(encoded)
+        self._pending = set(encoded.keys())
+
+    def __getitem__(self, pname):
+        value = self._values[pname]
+        if pname in self._pending:
+            value = _decode_value(self._table, pname, value)
+            self._values[pname] = value
+            self._pending.discard(pname)
+        return value
+
+    def __setitem__(self, pname, value):
+        self._values[pname] = value
+        self._pending.discard(pname)
+
+    def __delitem__(self, pname):
+        del self._values[pname]
+        self._pending.discard(pname)
+
+    def __contains__(self, pname):
+        return pname in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        return dict(self.items())
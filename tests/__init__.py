@@ -44,3 +44,27 @@ class AppEngineTestCase(unittest.TestCase):
         page = WikiPage.get_by_title(title)
         page.update_content(content, page.revision, user=self.get_cur_user(), dont_defer=True)
         return page
+
+
+class PatchingTestCase(AppEngineTestCase):
+    """Restores attributes replaced by patch() after each test"""
+    _unset = object()
+
+    def setUp(self):
+        super(PatchingTestCase, self).setUp()
+        self._patched = []
+
+    def tearDown(self):
+        for obj, name, value in reversed(self._patched):
+            if value is self._unset:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+        super(PatchingTestCase, self).tearDown()
+
+    def patch(self, obj, name, value):
+        """Replaces obj.name with value until the test ends"""
+        # keep the attribute itself, such as a classmethod, not what getattr makes of it
+        own = vars(obj)
+        self._patched.append((obj, name, own[name] if name in own else self._unset))
+        setattr(obj, name, value)
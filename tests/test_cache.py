@@ -1,9 +1,28 @@
 # -*- coding: utf-8 -*-
-from models import WikiPage
-from tests import AppEngineTestCase
+import caching
+import random
+import threading
+import unittest2 as unittest
+from models import WikiPage, md
+from tests import AppEngineTestCase, PatchingTestCase
 from google.appengine.api import memcache
 
 
+class CountingClient(object):
+    """Memcache client which counts RPCs"""
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+        return call
+
+
 class WikiPageUpdateTest(AppEngineTestCase):
     def setUp(self):
         super(WikiPageUpdateTest, self).setUp()
@@ -35,23 +54,433 @@ class WikiPageUpdateTest(AppEngineTestCase):
         self.assertIsNotNone(memcache.get(u'model\trendered_body\tHello'))
 
     def test_titles_cache(self):
-        cache_key = u'model\ttitles\tNone'
-        self.assertIsNone(memcache.get(cache_key))
+        self.assertIsNone(caching.get_titles('None'))
 
         # populate cache
         WikiPage.get_titles()
-        self.assertIsNotNone(memcache.get(cache_key))
+        self.assertIsNotNone(caching.get_titles('None'))
 
         # invalidate cache by adding new page
         page = WikiPage.get_by_title(u'Hello')
         page.update_content(u'Hello', 0, user=self.get_cur_user())
-        self.assertEqual(None, memcache.get(cache_key))
+        self.assertEqual(None, caching.get_titles('None'))
 
         # populate cache again
         WikiPage.get_titles()
-        self.assertIsNotNone(memcache.get(cache_key))
+        self.assertIsNotNone(caching.get_titles('None'))
 
         # Should not be invalidated because it's just an update
         page = WikiPage.get_by_title(u'Hello')
         page.update_content(u'Hello 2', 1, user=self.get_cur_user())
-        self.assertIsNotNone(memcache.get(cache_key))
+        self.assertIsNotNone(caching.get_titles('None'))
+
+    def test_invalidating_titles_should_not_flush_other_caches(self):
+        page = WikiPage.get_by_title(u'Hello')
+        page.update_content(u'Hello', 0, user=self.get_cur_user())
+        _ = page.rendered_body
+        WikiPage.get_titles(self.get_cur_user())
+
+        caching.del_titles()
+
+        self.assertIsNone(caching.get_titles('ak@gmail.com'))
+        self.assertIsNotNone(memcache.get(u'model\trendered_body\tHello'))
+
+
+class SharedTitlesTest(PatchingTestCase):
+    def setUp(self):
+        super(SharedTitlesTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.update_page(u'Hello', u'Public')
+        self.update_page(u'.read ak@gmail.com\nHello', u'AK only')
+        self.update_page(u'.read login\nHello', u'Members only')
+
+    def test_titles_should_respect_read_acl(self):
+        self.assertEqual({u'Public'}, WikiPage.get_titles())
+        self.assertEqual({u'Public', u'AK only', u'Members only'}, WikiPage.get_titles(self.get_cur_user()))
+
+        self.login('jh@gmail.com', 'jh')
+        self.assertEqual({u'Public', u'Members only'}, WikiPage.get_titles(self.get_cur_user()))
+
+    def test_users_should_keep_only_restricted_titles(self):
+        WikiPage.get_titles(self.get_cur_user())
+        self.assertEqual({u'Public'}, caching.get_titles('None'))
+        self.assertEqual({u'AK only', u'Members only'}, caching.get_titles('ak@gmail.com'))
+
+    def test_pages_should_be_grouped_by_acl(self):
+        index = WikiPage.get_title_index()
+        self.assertEqual({u'Public'}, index[(u'', u'')])
+        self.assertEqual({u'AK only'}, index[(u'ak@gmail.com', u'')])
+        self.assertEqual({u'Members only'}, index[(u'login', u'')])
+
+    def test_new_page_should_be_added_to_cached_index(self):
+        WikiPage.get_title_index()
+        built = []
+        orig_build = WikiPage._build_title_index
+        self.patch(WikiPage, '_build_title_index', classmethod(lambda cls: built.append(1) or orig_build()))
+        self.update_page(u'Hello', u'New')
+        self.assertEqual({u'Public', u'New'}, WikiPage.get_titles())
+        self.assertEqual([], built)
+
+    def test_acl_change_should_move_title(self):
+        WikiPage.get_titles()
+        self.update_page(u'.read ak@gmail.com\nHello', u'Public')
+        self.assertEqual(set(), WikiPage.get_titles())
+        self.assertEqual({u'Public', u'AK only'}, WikiPage.get_title_index()[(u'ak@gmail.com', u'')])
+
+    def test_deleted_page_should_be_removed(self):
+        WikiPage.get_titles()
+        self.login('admin@gmail.com', 'admin', is_admin=True)
+        WikiPage.get_by_title(u'Public').delete(self.get_cur_user())
+        self.assertEqual(set(), WikiPage.get_titles())
+
+    def test_index_larger_than_compression_threshold_should_be_updated_in_place(self):
+        index = {(u'', u''): set(u'Page %d' % i for i in range(3000))}
+        caching.set_title_index(index)
+        self.assertTrue(memcache.get(u'model\ttitle_index\t%d\t' % caching._get_generation('titles')).startswith('\0zlib\0'))
+
+        self.assertTrue(caching.update_title_index(lambda index: index[(u'', u'')].add(u'New')))
+        caching.create_prc()
+        caching.local.flush_all()
+        self.assertEqual(3001, len(caching.get_title_index()[(u'', u'')]))
+        self.assertIn(u'New', caching.get_title_index()[(u'', u'')])
+
+    def test_rebuild_should_not_overwrite_index_updated_meanwhile(self):
+        orig_build = WikiPage._build_title_index
+        built = []
+
+        def build(cls):
+            index = orig_build()
+            if not built:
+                built.append(1)
+                # other request builds the index and adds a page to it meanwhile
+                caching.set_title_index(orig_build())
+                caching.update_title_index(lambda index: index[(u'', u'')].add(u'New'))
+            return index
+
+        self.patch(WikiPage, '_build_title_index', classmethod(build))
+        WikiPage.get_title_index()
+        caching.create_prc()
+        self.assertEqual({u'Public', u'New'}, WikiPage.get_titles())
+
+    def test_rebuild_should_not_be_stored_if_page_is_added_meanwhile(self):
+        orig_build = WikiPage._build_title_index
+        built = []
+
+        def build(cls):
+            index = orig_build()
+            if not built:
+                built.append(1)
+                self.update_page(u'Hello', u'New')
+            return index
+
+        self.patch(WikiPage, '_build_title_index', classmethod(build))
+        WikiPage.get_title_index()
+        caching.create_prc()
+        self.assertEqual({u'Public', u'New'}, WikiPage.get_titles())
+
+    def test_reconcile_should_fix_lost_updates(self):
+        WikiPage.get_titles()
+        caching.set_title_index({})
+        self.assertEqual(set(), WikiPage.get_titles())
+
+        WikiPage.reconcile_title_index()
+        self.assertEqual({u'Public'}, WikiPage.get_titles())
+
+
+class LocalCacheTest(unittest.TestCase):
+    def test_least_recently_used_should_be_evicted(self):
+        cache = caching.LocalCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_expired_entry_should_not_be_returned(self):
+        cache = caching.LocalCache(2, 60)
+        cache.set('a', 1, -1)
+        self.assertIsNone(cache.get('a'))
+
+
+class LocalTierTest(AppEngineTestCase):
+    def setUp(self):
+        super(LocalTierTest, self).setUp()
+        caching.reset_stats()
+
+    def test_config_should_be_served_from_local_tier(self):
+        caching.set_config({'a': 1})
+        caching.create_prc()
+        memcache.delete('model\tconfig')
+
+        self.assertEqual({'a': 1}, caching.get_config())
+        self.assertEqual({'hits': 1, 'misses': 0}, caching.get_stats()['local'])
+        self.assertNotIn('memcache', caching.get_stats())
+
+    def test_invalidation_on_other_instance_should_be_noticed(self):
+        caching.set_config({'a': 1})
+        caching.create_prc()
+
+        # other instance deletes config
+        memcache.incr('generation\tconfig')
+        memcache.delete('model\tconfig')
+
+        # still served until the generation seen by this instance expires
+        self.assertEqual({'a': 1}, caching.get_config())
+        caching.create_prc()
+        caching.local.delete('generation\tconfig')
+        self.assertIsNone(caching.get_config())
+
+    def test_titles_should_be_invalidated_by_generation(self):
+        caching.set_titles('None', {u'A'})
+        self.assertEqual({u'A'}, caching.get_titles('None'))
+
+        caching.del_titles()
+        self.assertIsNone(caching.get_titles('None'))
+        self.assertEqual({'hits': 1, 'misses': 1}, caching.get_stats()['local'])
+
+    def test_stats_should_count_every_hit_from_concurrent_threads(self):
+        def run():
+            for _ in range(2000):
+                caching._count('local', True)
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({'hits': 16000, 'misses': 0}, caching.get_stats()['local'])
+
+
+class PrefetchTest(PatchingTestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.patch(caching, 'c', CountingClient(caching.c))
+
+    def test_page_keys_should_be_fetched_in_one_round_trip(self):
+        caching.set_rendered_body(u'Hello', u'<p>Hello</p>')
+        caching.set_hashbangs(u'Hello', [])
+        caching.set_metadata(u'Hello', {u'content-type': u'text/x-markdown'})
+        caching.set_data(u'Hello', {u'name': u'Hello'})
+        caching.create_prc()
+        caching.c.calls = []
+
+        caching.prefetch_page(u'Hello')
+        self.assertEqual(u'<p>Hello</p>', caching.get_rendered_body(u'Hello'))
+        self.assertEqual([], caching.get_hashbangs(u'Hello'))
+        self.assertEqual({u'content-type': u'text/x-markdown'}, caching.get_metadata(u'Hello'))
+        self.assertEqual({u'name': u'Hello'}, caching.get_data(u'Hello'))
+        self.assertEqual(['get_multi'], caching.c.calls)
+
+    def test_prefetched_keys_should_not_be_fetched_again(self):
+        caching.set_rendered_body(u'Hello', u'<p>Hello</p>')
+        caching.set_hashbangs(u'Hello', [])
+        caching.set_metadata(u'Hello', {})
+        caching.set_data(u'Hello', {})
+        caching.create_prc()
+        caching.prefetch_page(u'Hello')
+        caching.c.calls = []
+
+        caching.prefetch_page(u'Hello')
+        caching.get_rendered_body(u'Hello')
+        self.assertEqual([], caching.c.calls)
+
+
+class NegativeCachingTest(PatchingTestCase):
+    def setUp(self):
+        super(NegativeCachingTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.patch(caching, 'c', CountingClient(caching.c))
+
+    def render(self, title):
+        caching.create_prc()
+        caching.c.calls = []
+        page = WikiPage.get_by_title(title)
+        caching.prefetch_page(title)
+        for _ in range(2):
+            page.metadata, page.rendered_body
+        return caching.c.calls
+
+    def test_empty_page_should_not_be_rendered_again(self):
+        page = WikiPage.get_by_title(u'Empty')
+        page.update_content(u'.pub', 0, user=self.get_cur_user())
+
+        self.render(u'Empty')
+        self.assertEqual(['get_multi'], self.render(u'Empty'))
+        self.assertEqual(u'', caching.get_rendered_body(u'Empty'))
+
+    def test_missing_page_should_not_be_rendered_again(self):
+        self.render(u'Missing')
+        self.assertEqual(['get_multi'], self.render(u'Missing'))
+
+    def test_miss_should_be_looked_up_once_per_request(self):
+        self.assertIsNone(caching.get_wikiquery(u'name:Hello', u'None'))
+        self.assertIsNone(caching.get_wikiquery(u'name:Hello', u'None'))
+        self.assertEqual(['get'], caching.c.calls)
+
+    def test_none_should_be_cached_for_a_short_time(self):
+        caching.set_metadata(u'Hello', None)
+        caching.create_prc()
+        caching.c.calls = []
+        caching.reset_stats()
+
+        self.assertIsNone(caching.get_metadata(u'Hello'))
+        self.assertIsNone(caching.get_metadata(u'Hello'))
+        self.assertEqual(['get'], caching.c.calls)
+        self.assertEqual({'hits': 1, 'misses': 0}, caching.get_stats()['memcache'])
+
+
+class LeaseTest(PatchingTestCase):
+    def setUp(self):
+        super(LeaseTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.patch(caching, 'lease_wait_sec', 0.2)
+
+        page = WikiPage.get_by_title(u'Hello')
+        page.update_content(u'Hello', 0, user=self.get_cur_user())
+        _ = page.rendered_body
+
+    def test_lease_should_be_released_after_rendering(self):
+        caching.del_rendered_body(u'Hello')
+        caching.create_prc()
+        _ = WikiPage.get_by_title(u'Hello').rendered_body
+        self.assertIsNone(memcache.get(u'lease\tmodel\trendered_body\tHello'))
+
+    def test_stale_copy_should_be_served_while_other_request_renders(self):
+        page = WikiPage.get_by_title(u'Hello')
+        page.update_content(u'Hello 2', 1, user=self.get_cur_user())
+        caching.create_prc()
+
+        # other request is rendering
+        memcache.add(u'lease\tmodel\trendered_body\tHello', 1)
+        self.assertIn(u'Hello', page.rendered_body)
+        self.assertNotIn(u'Hello 2', page.rendered_body)
+        self.assertIsNone(memcache.get(u'model\trendered_body\tHello'))
+
+    def test_should_render_if_other_request_does_not_finish(self):
+        page = WikiPage.get_by_title(u'Hello')
+        page.update_content(u'Hello 2', 1, user=self.get_cur_user())
+        memcache.delete(u'stale\tmodel\trendered_body\tHello')
+        caching.create_prc()
+
+        memcache.add(u'lease\tmodel\trendered_body\tHello', 1)
+        self.assertIn(u'Hello 2', page.rendered_body)
+
+    def test_stale_title_set_should_not_be_served(self):
+        self.assertEqual({u'Hello'}, WikiPage.get_titles())
+        WikiPage.get_by_title(u'World').update_content(u'World', 0, user=self.get_cur_user())
+        caching.create_prc()
+
+        # other request is building title set of new generation
+        generation = caching._get_generation('title_sets')
+        memcache.add(u'lease\tmodel\ttitles\t%d\tNone' % generation, 1)
+        self.assertEqual({u'Hello', u'World'}, WikiPage.get_titles())
+        self.assertEqual({u'Hello', u'World'}, caching.get_titles(u'None'))
+
+    def test_title_set_computed_while_generation_moves_should_not_be_stored(self):
+        def compute():
+            # other request changes a page meanwhile
+            caching._bump_generation('title_sets')
+            return {u'Hello'}
+
+        self.assertEqual({u'Hello'}, caching.compute_titles(u'None', compute))
+        self.assertIsNone(caching.get_titles(u'None'))
+
+
+class LargeValueTest(PatchingTestCase):
+    def setUp(self):
+        super(LargeValueTest, self).setUp()
+        caching.reset_stats()
+        self.patch(caching, 'chunk_size', 64 * 1024)
+
+    def incompressible(self, size):
+        return u''.join(random.choice(u'abcdefghijklmnopqrstuvwxyz가나다라') for _ in range(size))
+
+    def test_large_value_should_be_compressed(self):
+        html = u'<p>Hello</p>' * 10000
+        caching.set_rendered_body(u'Hello', html)
+        self.assertTrue(memcache.get(u'model\trendered_body\tHello').startswith('\0zlib\0'))
+
+        caching.create_prc()
+        self.assertEqual(html, caching.get_rendered_body(u'Hello'))
+
+    def test_value_larger_than_chunk_should_be_split(self):
+        html = self.incompressible(100 * 1024)
+        caching.set_rendered_body(u'Hello', html)
+        self.assertTrue(memcache.get(u'model\trendered_body\tHello').startswith('\0chunks\0'))
+
+        caching.create_prc()
+        self.assertEqual(html, caching.get_rendered_body(u'Hello'))
+        caching.create_prc()
+        caching.prefetch_page(u'Hello')
+        self.assertEqual(html, caching.prc.get(u'model\trendered_body\tHello'))
+
+    def test_missing_chunk_should_be_a_miss(self):
+        caching.set_rendered_body(u'Hello', self.incompressible(100 * 1024))
+        version = memcache.get(u'model\trendered_body\tHello').split('\0')[2]
+        memcache.delete(u'chunk\t%s\t1\tmodel\trendered_body\tHello' % version)
+
+        caching.create_prc()
+        self.assertIsNone(caching.get_rendered_body(u'Hello'))
+
+    def test_rewrite_should_not_mix_chunks(self):
+        caching.set_rendered_body(u'Hello', self.incompressible(100 * 1024))
+        old_manifest = memcache.get(u'model\trendered_body\tHello')
+        html = self.incompressible(100 * 1024)
+        caching.set_rendered_body(u'Hello', html)
+        self.assertNotEqual(old_manifest, memcache.get(u'model\trendered_body\tHello'))
+
+        caching.create_prc()
+        self.assertEqual(html, caching.get_rendered_body(u'Hello'))
+
+    def test_uncacheable_value_should_be_counted(self):
+        class FailingClient(object):
+            def set_multi(self, mapping, time=0):
+                return mapping.keys()
+
+        self.patch(caching, 'c', FailingClient())
+        caching.set_markdown_html('digest', self.incompressible(100 * 1024))
+        self.assertEqual({'values': 1}, caching.get_stats()['uncacheable'])
+
+
+class PreviewCacheTest(AppEngineTestCase):
+    def setUp(self):
+        super(PreviewCacheTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.update_page(u'\n\n'.join(u'# Part %d\nParagraph %d' % (i, i) for i in range(50)), u'Hello')
+
+    def test_stamp_should_depend_on_body_and_page(self):
+        page = WikiPage.get_by_title(u'Hello')
+        stamp = page.preview_stamp(u'Preview')
+        self.assertEqual(stamp, page.preview_stamp(u'Preview'))
+        self.assertNotEqual(stamp, page.preview_stamp(u'Preview 2'))
+        self.assertEqual(page.render_stamp, page.preview_stamp(page.body))
+
+        self.update_page(u'[[Hello]]', u'Other')
+        self.assertNotEqual(stamp, WikiPage.get_by_title(u'Hello').preview_stamp(u'Preview'))
+
+    def test_preview_should_be_cached_by_stamp(self):
+        page = WikiPage.get_by_title(u'Hello')
+        caching.set_preview(page.title, page.preview_stamp(u'Preview'), u'<p>Preview</p>')
+        caching.create_prc()
+
+        self.assertEqual(u'<p>Preview</p>', caching.get_preview(page.title, page.preview_stamp(u'Preview')))
+        self.assertIsNone(caching.get_preview(page.title, page.preview_stamp(u'Preview 2')))
+
+    def test_preview_should_reuse_blocks_of_rendered_body(self):
+        page = WikiPage.get_by_title(u'Hello')
+        page.rendered_body
+        caching.create_prc()
+
+        converted = []
+        convert = md.convert
+        md.convert = lambda text: converted.append(text) or convert(text)
+        try:
+            preview = page.get_preview_instance(page.body.replace(u'Paragraph 25', u'Edited 25'))
+            self.assertIn(u'<p>Edited 25</p>', preview.rendered_body)
+        finally:
+            del md.convert
+        self.assertEqual(1, len(converted))
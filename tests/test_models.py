@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 import main
+import caching
 import unittest2 as unittest
 from itertools import groupby
-from tests import AppEngineTestCase
+from tests import AppEngineTestCase, PatchingTestCase
 from google.appengine.api import users
 from markdownext.md_wikilink import parse_wikilinks
-from models import WikiPage, PageOperationMixin, UserPreferences, title_grouper, ConflictError
+from models import WikiPage, PageOperationMixin, UserPreferences, SchemaDataIndex, title_grouper, ConflictError, md, page_operation_mixin
 
 
 class PartialUpdateTest(AppEngineTestCase):
@@ -40,6 +41,89 @@ class PartialUpdateTest(AppEngineTestCase):
         self.assertEqual(u'.pub\n[x] Item A', page.body)
 
 
+class PartialUpdateFastPathTest(PatchingTestCase):
+    def setUp(self):
+        super(PartialUpdateFastPathTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.full_updates = []
+        orig_update_content_all = WikiPage._update_content_all
+
+        def update_content_all(page, body, *args):
+            self.full_updates.append(body)
+            return orig_update_content_all(page, body, *args)
+        self.patch(WikiPage, '_update_content_all', update_content_all)
+
+    def update_partial(self, body, content, partial, title=u'Hello'):
+        page = WikiPage.get_by_title(title)
+        page.update_content(body, 0, user=self.get_cur_user(), dont_defer=True)
+        del self.full_updates[:]
+        page.update_content(content, 1, partial=partial, user=self.get_cur_user(), dont_defer=True)
+        return WikiPage.get_by_title(title)
+
+    def test_checkbox_in_plain_text(self):
+        page = self.update_partial(u'Items\n\n* [ ] A [[Link]]\n* [x] B', u'1', 'checkbox[0]')
+        self.assertEqual([], self.full_updates)
+        self.assertEqual(u'Items\n\n* [x] A [[Link]]\n* [x] B', page.body)
+        self.assertEqual(2, page.revision)
+        self.assertEqual(2, len(page.revisions.fetch()))
+        self.assertEqual(page.body, page.data['articleBody'].pvalue)
+        self.assertEqual({u'Article/relatedTo': [u'Link']}, page.outlinks)
+        self.assertEqual(2, page.rendered_body.count(u'checked'))
+
+    def test_log_in_section(self):
+        page = self.update_partial(u'description::---\n\n* [__]', u'Hello', 'log[0]')
+        self.assertEqual([], self.full_updates)
+        self.assertEqual(u'description::---\n\n* Hello\n* [__]', page.body)
+        self.assertEqual(u'* Hello\n* [__]', page.data['description'].pvalue)
+        self.assertEqual([u'Hello'], SchemaDataIndex.query_titles(u'description', u'* Hello\n* [__]'))
+        self.assertEqual([], SchemaDataIndex.query_titles(u'description', u'* [__]'))
+
+    def test_partials_in_data_links_or_headings_should_be_fully_updated(self):
+        cases = [
+            (u'    #!yaml/schema\n    # [ ] A\n    author: B\n', u'1', 'checkbox[0]'),
+            (u'[[A [ ] B]]', u'1', 'checkbox[0]'),
+            (u'# [ ] A', u'1', 'checkbox[0]'),
+            (u'[ ] A\n===', u'1', 'checkbox[0]'),
+            (u'<h1>\n[ ] A\n</h1>', u'1', 'checkbox[0]'),
+            (u'* [__]', u'[[Link]]', 'log[0]'),
+            (u'* [__]', u'A\n# B', 'log[0]'),
+            (u'[__]', u'.pub', 'log[0]'),
+            (u'.schema Book\n\nHello\n\nauthor::---\n\n[ ] Alan', u'1', 'checkbox[0]'),
+        ]
+        for i, (body, content, partial) in enumerate(cases):
+            self.update_partial(body, content, partial, u'Page %d' % i)
+            self.assertEqual(1, len(self.full_updates), body)
+
+    def test_checkbox_should_have_same_result_as_full_update(self):
+        lines = []
+        for i in range(200):
+            if i % 20 == 0:
+                lines += [u'', u'# Group %d' % i, u'']
+            lines.append(u'* [ ] task %d with [[Link %d]]' % (i, i))
+        body = u'\n'.join(lines)
+
+        partial = self.update_partial(body, u'1', 'checkbox[100]', u'A')
+        self.assertEqual([], self.full_updates)
+        full = WikiPage.get_by_title(u'B')
+        full.update_content(body.replace(u'[ ] task 100 ', u'[x] task 100 '), 0, user=self.get_cur_user(), dont_defer=True)
+
+        self.assertEqual(full.body, partial.body)
+        self.assertEqual(full.rendered_body, partial.rendered_body)
+        self.assertEqual(full.outlinks, partial.outlinks)
+        self.assertEqual(set(full.rawdata.keys()), set(partial.rawdata.keys()))
+        self.assertEqual(full.rawdata['articleBody'], partial.rawdata['articleBody'])
+
+    def test_checkbox_in_linked_section_should_update_links(self):
+        page = self.update_partial(u'.schema Book\n\nHello\n\nauthor::---\n\n[ ] Alan', u'1', 'checkbox[0]')
+        self.assertEqual({u'Book/author': [u'[x] Alan']}, page.outlinks)
+        self.assertEqual({u'Book/author': [u'Hello']}, WikiPage.get_by_title(u'[x] Alan').inlinks)
+        self.assertEqual({}, WikiPage.get_by_title(u'[ ] Alan').inlinks)
+
+    def test_log_with_link_should_update_links(self):
+        page = self.update_partial(u'* [__]', u'[[Link]]', 'log[0]')
+        self.assertEqual({u'Article/relatedTo': [u'Link']}, page.outlinks)
+
+
 class PageUpdateTest(AppEngineTestCase):
     def test_should_update_acls(self):
         self.login('ak', 'ak', True)
@@ -121,6 +205,9 @@ class PageValidationTest(AppEngineTestCase):
     def test_duplicated_headings(self):
         self.assertRaises(ValueError, self.update_page, u'# A\n# A')
 
+    def test_headings_should_be_validated_as_rendered(self):
+        self.assertRaises(ValueError, self.update_page, u'<H2>A</H2>')
+
     def test_malformed_yaml_schema(self):
         self.assertRaises(ValueError, self.update_page, u'.schema Book\n\n    #!yaml/schema\n    y: [1, 2\n')
 
@@ -184,6 +271,64 @@ class MetadataParserTest(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+class LargeDocumentParserTest(AppEngineTestCase):
+    """Parsers should stay linear for 1MB bodies such as long meeting logs"""
+    def setUp(self):
+        super(LargeDocumentParserTest, self).setUp()
+        self.body = self.log_body(1024 * 1024 / 8)
+
+    def log_body(self, size):
+        lines = [u'.pub Log', u'.read all']
+        for i in range(size):
+            lines.append(u'* [__]' if i % 1000 else u'log%d::---' % i)
+        return u'\n'.join(lines)
+
+    def count_matches(self, name, func, body):
+        """Returns how many times func matches a line against pattern PageOperationMixin.<name>"""
+        matches = []
+        pattern = getattr(PageOperationMixin, name)
+
+        class CountingPattern(object):
+            def match(self, line):
+                matches.append(line)
+                return pattern.match(line)
+
+        setattr(PageOperationMixin, name, CountingPattern())
+        try:
+            func(body)
+        finally:
+            setattr(PageOperationMixin, name, pattern)
+        return len(matches)
+
+    def test_parse_metadata(self):
+        metadata = PageOperationMixin.parse_metadata(self.body)
+        self.assertEqual(u'all', metadata['read'])
+
+    def test_remove_metadata(self):
+        content = PageOperationMixin.remove_metadata(self.body)
+        self.assertTrue(content.startswith(u'log0::---\n'))
+
+    def test_parse_sections(self):
+        sections = PageOperationMixin.parse_sections(self.body)
+        self.assertEqual(132, len(sections))
+        self.assertEqual(999, sections[u'log1000'].count(u'[__]'))
+
+    def test_parse_data(self):
+        data = PageOperationMixin.parse_data(u'Log', self.body)
+        self.assertEqual(u'Log', data['name'].pvalue)
+
+    def test_metadata_parsers_should_read_only_leading_lines(self):
+        for func in [PageOperationMixin.parse_metadata, PageOperationMixin.remove_metadata]:
+            self.assertEqual(3, self.count_matches('re_metadata', func, self.body))
+            self.assertEqual(3, self.count_matches('re_metadata', func, self.log_body(10)))
+
+    def test_parse_sections_should_match_each_line_once(self):
+        small = self.count_matches('re_section_data', PageOperationMixin.parse_sections, self.log_body(10000))
+        large = self.count_matches('re_section_data', PageOperationMixin.parse_sections, self.log_body(20000))
+        self.assertLessEqual(large, 2 * small)
+        self.assertLessEqual(small, 10000 + 1)
+
+
 class WikiLinkParserTest(unittest.TestCase):
     def test_plain(self):
         self.assertEqual({u'Article/relatedTo': [u'A']},
@@ -857,6 +1002,245 @@ class WikiPageHierarchyTest(AppEngineTestCase):
         self.assertEqual({}, WikiPage.get_by_title(u'GEB/Chapter 1').inlinks)
 
 
+class WikiPageKeyTest(AppEngineTestCase):
+    def setUp(self):
+        super(WikiPageKeyTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        WikiPage._legacy_pages_migrated = False
+
+    def _put_legacy_page(self, title, body):
+        page = WikiPage(parent=WikiPage._root_key(), title=title, body=body, revision=1,
+                        inlinks={}, outlinks={}, related_links={})
+        page.put()
+        return page
+
+    def test_new_page_should_be_keyed_by_title(self):
+        page = self.update_page(u'Hello', u'A')
+        self.assertEqual(u'A', page.key.id())
+        self.assertEqual(WikiPage._root_key(), page.key.parent())
+
+    def test_legacy_page_should_be_migrated_on_read(self):
+        legacy = self._put_legacy_page(u'A', u'Hello')
+
+        page = WikiPage.get_by_title(u'A')
+        self.assertEqual(u'A', page.key.id())
+        self.assertEqual(u'Hello', page.body)
+        self.assertIsNone(legacy.key.get())
+
+    def test_migrate_all(self):
+        self._put_legacy_page(u'A', u'Hello')
+        self._put_legacy_page(u'B', u'There')
+
+        WikiPage.migrate_all_to_title_keys()
+        self.assertFalse(WikiPage._legacy_pages_migrated)
+        WikiPage.migrate_all_to_title_keys()
+        self.assertTrue(WikiPage._legacy_pages_migrated)
+
+        self.assertEqual([u'A', u'B'], sorted(k.id() for k in WikiPage.query().fetch(keys_only=True)))
+
+    def test_migrate_all_should_finish_with_duplicate_legacy_page(self):
+        self.update_page(u'Hello', u'A')
+        duplicate = self._put_legacy_page(u'A', u'Duplicate')
+
+        WikiPage.migrate_all_to_title_keys()
+        self.assertIsNone(duplicate.key.get())
+        WikiPage.migrate_all_to_title_keys()
+        self.assertTrue(WikiPage._legacy_pages_migrated)
+        self.assertEqual(u'Hello', WikiPage.get_by_title(u'A').body)
+
+    def test_update_after_read_should_be_migrated(self):
+        stale = self._put_legacy_page(u'A', u'Hello')
+        updated = stale.key.get(use_cache=False)
+        updated.body = u'Updated'
+        updated.put()
+
+        page = WikiPage._migrate_to_title_key(stale)
+        self.assertEqual(u'Updated', page.body)
+        self.assertIsNone(stale.key.get())
+
+    def test_page_should_be_migrated_once(self):
+        legacy = self._put_legacy_page(u'A', u'Hello')
+        first = WikiPage._migrate_to_title_key(legacy)
+        first.body = u'Updated'
+        first.put()
+
+        self.assertEqual(u'Updated', WikiPage._migrate_to_title_key(legacy).body)
+        self.assertEqual(u'Updated', WikiPage.get_by_title(u'A').body)
+
+    def test_legacy_page_should_be_looked_up_until_none_is_left(self):
+        self._put_legacy_page(u'A', u'Hello')
+        WikiPage.get_by_title(u'B')
+        self.assertFalse(WikiPage._legacy_pages_migrated)
+
+        WikiPage.get_by_title(u'A')
+        WikiPage.get_by_title(u'B')
+        self.assertTrue(WikiPage._legacy_pages_migrated)
+
+
+class GetByTitlesTest(PatchingTestCase):
+    def setUp(self):
+        super(GetByTitlesTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+
+    def test_get_existing_and_new_pages(self):
+        self.update_page(u'Hello', u'A')
+
+        pages = WikiPage.get_by_titles([u'A', u'B'])
+        self.assertEqual(u'Hello', pages[u'A'].body)
+        self.assertEqual(1, pages[u'A'].revision)
+        self.assertEqual(0, pages[u'B'].revision)
+
+    def test_follow_redirect_chain(self):
+        self.update_page(u'Hello', u'C')
+        self.update_page(u'.redirect C', u'B')
+        self.update_page(u'.redirect B', u'A')
+
+        pages = WikiPage.get_by_titles([u'A', u'B', u'D'], follow_redirect=True)
+        self.assertEqual(u'C', pages[u'A'].title)
+        self.assertEqual(u'C', pages[u'B'].title)
+        self.assertEqual(u'D', pages[u'D'].title)
+
+    def test_redirects_should_be_followed_without_cache_lookups(self):
+        self.update_page(u'Hello', u'C')
+        self.update_page(u'.redirect C', u'B')
+        self.update_page(u'.redirect B', u'A')
+        caching.create_prc()
+
+        looked_up = []
+        get_metadata = caching.get_metadata
+        self.patch(caching, 'get_metadata', lambda title: looked_up.append(title) or get_metadata(title))
+        pages = WikiPage.get_by_titles([u'A', u'B'], follow_redirect=True)
+        self.assertEqual(u'C', pages[u'A'].title)
+        self.assertEqual([], looked_up)
+
+    def test_should_not_follow_redirect_unless_requested(self):
+        self.update_page(u'.redirect B', u'A')
+        self.assertEqual(u'A', WikiPage.get_by_titles([u'A'])[u'A'].title)
+
+    def test_title_should_not_start_with_equal_sign(self):
+        self.assertRaises(ValueError, WikiPage.get_by_titles, [u'A', u'=B'])
+
+
+class PageAnalysisTest(PatchingTestCase):
+    def setUp(self):
+        super(PageAnalysisTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.parsed = []
+        orig_parse_metadata = PageOperationMixin.parse_metadata
+        orig_parse_schema_yaml = PageOperationMixin.parse_schema_yaml
+
+        def parse_metadata(cls, body):
+            self.parsed.append(('metadata', body))
+            return orig_parse_metadata(body)
+
+        def parse_schema_yaml(cls, body):
+            self.parsed.append(('yaml', body))
+            return orig_parse_schema_yaml(body)
+
+        self.patch(PageOperationMixin, 'parse_metadata', classmethod(parse_metadata))
+        self.patch(PageOperationMixin, 'parse_schema_yaml', classmethod(parse_schema_yaml))
+
+    def test_body_should_be_parsed_once_per_save(self):
+        body = u'.schema Book\n\n    #!yaml/schema\n    author: AK\n\n[[B]] and {{isbn::1234567890}}'
+        page = self.update_page(body, u'A')
+
+        self.assertEqual(1, self.parsed.count(('metadata', body)))
+        self.assertEqual(1, self.parsed.count(('yaml', body)))
+        self.assertEqual({u'Book/author': [u'AK'], u'Book/relatedTo': [u'B']}, page.outlinks)
+        self.assertEqual(u'1234567890', page.data['isbn'].pvalue)
+
+    def test_stored_analysis_should_be_used_after_cache_eviction(self):
+        body = u'.schema Book\n.read ak@gmail.com\n\n    #!yaml/schema\n    datePublished: 2013-01-01\n\n{{isbn::1234567890}}'
+        self.update_page(body, u'A')
+        caching.flush_all()
+        del self.parsed[:]
+
+        page = WikiPage.get_by_title(u'A')
+        self.assertEqual(u'ak@gmail.com', page.metadata['read'])
+        self.assertEqual(u'Book', page.itemtype)
+        self.assertEqual(u'1234567890', page.data['isbn'].pvalue)
+        self.assertEqual(2013, page.data['datePublished'].year)
+        self.assertEqual([], self.parsed)
+
+    def test_reuse_analysis_only_for_same_body(self):
+        page = self.update_page(u'.schema Book\nHello', u'A')
+        self.assertEqual(u'Book', page.itemtype)
+
+        page.body = u'Hello'
+        self.assertEqual(u'Article', page.analysis.itemtype)
+        self.assertIs(page.analysis, page.analysis)
+
+
+class RenderedBodyStoreTest(PatchingTestCase):
+    def setUp(self):
+        super(RenderedBodyStoreTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.rendered = []
+        orig_render_page = PageOperationMixin.render_page
+
+        def render_page(cls, title, *args, **kwargs):
+            self.rendered.append(title)
+            return orig_render_page(title, *args, **kwargs)
+
+        self.patch(PageOperationMixin, 'render_page', classmethod(render_page))
+
+    def test_should_survive_cache_flush(self):
+        self.update_page(u'Hello', u'A')
+        html = WikiPage.get_by_title(u'A').rendered_body
+        caching.flush_all()
+
+        self.assertEqual(html, WikiPage.get_by_title(u'A').rendered_body)
+        self.assertEqual([u'A'], self.rendered)
+
+    def test_should_be_rerendered_when_render_version_changed(self):
+        self.update_page(u'Hello', u'A')
+        WikiPage.get_by_title(u'A').rendered_body
+        caching.flush_all()
+
+        self.patch(page_operation_mixin, 'RENDER_VERSION', page_operation_mixin.RENDER_VERSION + 1)
+        WikiPage.get_by_title(u'A').rendered_body
+        self.assertEqual([u'A', u'A'], self.rendered)
+
+    def test_should_be_rerendered_when_inlinks_changed(self):
+        self.update_page(u'Hello', u'A')
+        WikiPage.get_by_title(u'A').rendered_body
+        self.update_page(u'[[A]]', u'B')
+        caching.flush_all()
+
+        self.assertIn(u'Incoming Links', WikiPage.get_by_title(u'A').rendered_body)
+        self.assertEqual([u'A', u'A'], self.rendered)
+
+
+class RenderingFragmentCacheTest(PatchingTestCase):
+    def setUp(self):
+        super(RenderingFragmentCacheTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.converted = []
+        orig_convert = md.convert
+
+        def convert(text):
+            self.converted.append(text)
+            return orig_convert(text)
+        self.patch(md, 'convert', convert)
+
+    def test_new_inlink_should_render_only_incoming_links(self):
+        self.update_page(u'# Hello\nWorld', u'A')
+        WikiPage.get_by_title(u'A').rendered_body
+        self.update_page(u'[[A]]', u'B')
+        del self.converted[:]
+
+        rendered = WikiPage.get_by_title(u'A').rendered_body
+        self.assertEqual(1, len(self.converted))
+        self.assertTrue(self.converted[0].startswith(u'# Incoming Links'))
+        self.assertTrue(rendered.startswith(u'<h1>Hello'))
+        self.assertIn(u'<a class="wikipage" href="/B">B</a>', rendered)
+
+    def test_generated_sections_should_follow_last_section(self):
+        html = PageOperationMixin.render_page(u'A', u'Intro\n\nabstract::---\n\nSome text', u'',
+                                              {u'Article/relatedTo': [u'B']})[0]
+        self.assertIn(u'<div class="section" itemprop="abstract">\n<p>Some text</p>\n</div>\n<h1>Incoming Links', html)
+
+
 class WikiPageBugsTest(AppEngineTestCase):
     def test_remove_acl_and_link_at_once_caused_an_error(self):
         self.login('ak@gmail.com', 'ak')
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import random
+import caching
 import unittest2 as unittest
-from models import PageOperationMixin
+from models import PageOperationMixin, TocGenerator, md, page_operation_mixin
+from tests import AppEngineTestCase
 
 
 class RenderingTestCase(unittest.TestCase):
@@ -239,3 +242,172 @@ class SectionRenderingTest(RenderingTestCase):
             u'description::---\n\nHello\n\naward::---\n\nThere\n',
             u'<div class="section" itemprop="description">\n<p>Hello</p>\n</div>\n<div class="section" itemprop="award">\n<p>There</p>\n</div>'
         )
+
+
+class BlockRenderingTest(AppEngineTestCase):
+    random_lines = [
+        u'Text *%d*', u'Text [[Link %d]]', u'{{author::Author %d}}', u'# H %d', u'## H %d', u'Setext %d', u'===', u'---',
+        u'* item %d', u'1. item %d', u'  * nested %d', u'  continued %d', u'    code %d', u'\tcode %d', u'> quote %d', u'>',
+        u'Term %d', u':   definition %d', u'| a | b %d |', u'|---|---|', u'a | b %d', u'[ ] task %d', u'[x] done %d',
+        u'<div>', u'</div>', u'<div>raw %d</div>', u'<p>raw %d</p>', u'<!-- comment %d -->', u'<!--', u'-->',
+        u'<span>inline %d</span>', u'<pre>', u'</pre>', u'<hr>', u'<?php %d ?>', u'<div markdown="1">',
+        u'http://www.youtube.com/watch?v=x%d', u'section%d::---', u'***', u'$$x^%d$$', u'  ', u'{.cls}',
+    ]
+
+    def test_pieces_should_start_at_headings_and_sections(self):
+        self.assertEqual([(None, [u'# A\n\nB', u'# C\n\nD']), (u'award', [u'## E'])],
+                         PageOperationMixin.split_blocks(u'# A\n\nB\n\n# C\n\nD\n\naward::---\n\n## E'))
+
+    def test_continued_blocks_should_not_be_split(self):
+        for text in [u'* a\n\n* b', u'A\n\n    code', u'> a\n\n> b', u'Term\n\n:   Definition',
+                     u'<div>\n\n# A\n\n</div>', u'[a][1]\n\n[1]: http://x.com']:
+            self.assertEqual([(None, [text])], PageOperationMixin.split_blocks(text))
+
+    def test_should_render_same_as_whole_text(self):
+        texts = [
+            u'# A\n\nB *b*\n\n# C\n\n* c\n* d\n\n    code\n\nE',
+            u'Intro\n\na&b::---\n\n# A\n\nB\n\nempty::---\n\nlast::---\n\n* c',
+            u'# A\n\n<div>raw\n\n# B\n\n</div>\n\n# C',
+            u'# A\n\nhttp://www.youtube.com/watch?v=x\n\n# B',
+            u'A\n\nTerm\n:   Definition\n\nB\n\n:   Definition',
+            u'outer::---\n\nA\n\n\ninner::---\n\nB',
+        ]
+        for text in texts:
+            self.assertEqual(md.convert(text), PageOperationMixin.render_blocks(text))
+
+    def test_random_text_should_render_same_as_whole_text(self):
+        rnd = random.Random(0)
+        for _ in range(200):
+            lines = []
+            for i in range(rnd.randint(3, 40)):
+                line = u'' if rnd.random() < 0.35 else rnd.choice(self.random_lines)
+                lines.append(line % i if u'%d' in line else line)
+            text = u'\n'.join(lines)
+            self.assertEqual(md.convert(text), PageOperationMixin.render_blocks(text), text)
+
+    def test_ambiguous_text_should_be_a_single_block(self):
+        for text in [u'# A\n\n<div>\n\n# B\n\nC', u'# A\n\n<!--\n\n# B']:
+            self.assertEqual([(None, [text])], PageOperationMixin.split_blocks(text))
+
+    def test_raw_html_which_cannot_be_followed_should_be_a_single_block(self):
+        text = u'# A\n\n<div>raw</div>\n\n# B'
+        html_block = PageOperationMixin._html_block
+        PageOperationMixin._html_block = None
+        try:
+            self.assertEqual([(None, [text])], PageOperationMixin.split_blocks(text))
+        finally:
+            PageOperationMixin._html_block = html_block
+
+
+class HtmlBlockHelperTest(unittest.TestCase):
+    """Pins private helpers of HtmlBlockPreprocessor which split_blocks relies on"""
+    def setUp(self):
+        super(HtmlBlockHelperTest, self).setUp()
+        self.html = PageOperationMixin._html_block
+
+    def test_left_tag_should_return_tag_end_of_tag_and_attrs(self):
+        self.assertEqual((u'div', 15, {u'class': u'a'}), self.html._get_left_tag(u'<div class="a">raw</div>'))
+
+    def test_right_tag_should_return_closing_tag_and_end_of_it(self):
+        self.assertEqual((u'/div', 24), self.html._get_right_tag(u'div', 15, u'<div class="a">raw</div>'))
+        self.assertEqual((u'/div', 9), self.html._get_right_tag(u'div', 0, u'raw</div>\n\n# B'))
+        self.assertEqual((u'--', 10), self.html._get_right_tag(u'--', 2, u'<!-- c -->'))
+
+    def test_right_tag_of_unclosed_block_should_end_at_end_of_block(self):
+        right_tag, index = self.html._get_right_tag(u'div', 5, u'<div>raw')
+        self.assertEqual(8, index)
+        self.assertFalse(self.html._equal_tags(u'div', right_tag))
+
+    def test_equal_tags_should_match_closing_tag_only(self):
+        self.assertTrue(self.html._equal_tags(u'div', u'/div'))
+        self.assertTrue(self.html._equal_tags(u'--', u'--'))
+        self.assertFalse(self.html._equal_tags(u'div', u'div'))
+        self.assertFalse(self.html._equal_tags(u'div', u'/p'))
+
+    def test_oneliner(self):
+        self.assertTrue(self.html._is_oneliner(u'hr'))
+        self.assertFalse(self.html._is_oneliner(u'div'))
+
+
+class IncrementalRenderingTest(AppEngineTestCase):
+    """Editing a line of a long page should convert only the block it is in"""
+    def setUp(self):
+        super(IncrementalRenderingTest, self).setUp()
+        lines = []
+        # about 5000 lines
+        for i in range(555):
+            if i % 20 == 0:
+                lines += [u'part%d::---' % i, u'']
+            lines += [
+                u'## Chapter %d' % i,
+                u'',
+                u'Paragraph *%d* with [[Link %d]] and {{author::Author %d}}.' % (i, i, i),
+                u'',
+                u'* item %d' % i,
+                u'* [ ] task %d' % i,
+                u'',
+                u'    code %d' % i,
+                u'',
+            ]
+        self.lines = lines
+        self.body = u'\n'.join(self.lines)
+
+        self.converted = []
+        self.convert = md.convert
+        md.convert = lambda text: self.converted.append(text) or self.convert(text)
+
+    def tearDown(self):
+        del md.convert
+        super(IncrementalRenderingTest, self).tearDown()
+
+    def test_same_html_as_rendering_at_once(self):
+        self.assertEqual(self.convert(self.body), PageOperationMixin.render_blocks(self.body))
+
+    def test_one_line_edit_should_convert_one_block(self):
+        PageOperationMixin.render_blocks(self.body)
+
+        index = self.lines.index(u'Paragraph *50* with [[Link 50]] and {{author::Author 50}}.')
+        self.lines[index] = u'Edited *paragraph*.'
+        edited = u'\n'.join(self.lines)
+        caching.create_prc()
+        del self.converted[:]
+
+        html = PageOperationMixin.render_blocks(edited)
+        self.assertEqual(1, len(self.converted))
+        self.assertEqual(self.convert(edited), html)
+
+    def test_render_version_bump_should_convert_every_block_again(self):
+        PageOperationMixin.render_blocks(self.body)
+        caching.create_prc()
+        del self.converted[:]
+
+        page_operation_mixin.RENDER_VERSION += 1
+        try:
+            PageOperationMixin.render_blocks(self.body)
+        finally:
+            page_operation_mixin.RENDER_VERSION -= 1
+        self.assertEqual(sum(len(blocks) for _, blocks in PageOperationMixin.split_blocks(self.body)),
+                         len(self.converted))
+
+
+class PostProcessingTest(unittest.TestCase):
+    def test_hashbangs_should_be_found_while_rendering(self):
+        html, hashbangs = PageOperationMixin.render_page(u'Hello', u'    #!python\n    print 1\n\n$$x^2$$')
+        self.assertEqual(['python', 'mathjax'], hashbangs)
+        self.assertEqual(hashbangs, PageOperationMixin.extract_hashbangs(html))
+
+    def test_structured_data_heading_should_not_be_in_toc(self):
+        data = u'<div class="structured-data"><h1>Structured data</h1></div>'
+        html = PageOperationMixin.render_body(u'Hello', u'# A\n# B\n# C\n# D\n# E', data)
+        self.assertTrue(html.startswith(data + u'<div class="toc">'))
+        self.assertNotIn(u'#h_', html[:html.index(u'<div class="toc">')])
+        self.assertEqual(5, html.count(u'class="caret-target"'))
+
+    def test_anchor_should_be_hashed_from_heading_as_markdown_writes_it(self):
+        html = PageOperationMixin.render_body(u'Hello', u'# A &copy; B<br />C & D')
+        self.assertIn(u'id="h_%s"' % TocGenerator.hash_str(u'A &copy; B<br />C &amp; D'), html)
+
+    def test_unsafe_markup_should_be_removed_after_toc(self):
+        html = PageOperationMixin.render_body(u'Hello', u'# A <script>alert(1)</script>\n\nB')
+        self.assertNotIn(u'script', html)
+        self.assertIn(u'class="caret-target"', html)
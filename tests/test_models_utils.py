@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
+import threading
 from unittest2 import TestCase
-from models.utils import merge_dicts, pairs_to_dict
+from models.utils import merge_dicts, pairs_to_dict, create_markdown, md
 
 
 class PairsToDictTest(TestCase):
@@ -54,3 +55,56 @@ class MergeDictTest(TestCase):
     def test_force_list(self):
         self.assertEqual({'a': [1], 'b': [2], 'c': [3]},
                          merge_dicts([{'a': 1}, {'b': 2, 'c': 3}], force_list=True))
+
+
+class MarkdownPoolTest(TestCase):
+    texts = [
+        u'# Title %d\n\n[[Page %d]] and **bold** text\n\n* item\n* [[author::Person %d]]',
+        u'Header %d | Value\n--- | ---\n[[Cell %d]] | ~~%d~~',
+        u'Term %d\n:   Definition [[Link %d]]\n\n$$x^%d$$',
+        u'http://example.com/%d\n\n## Section %d\n\nText {: .class%d}',
+    ]
+
+    def test_each_thread_should_have_its_own_instance(self):
+        instances = []
+
+        def run():
+            instances.append(md.instance)
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(3, len(set(id(i) for i in instances)))
+
+    def test_references_should_not_be_kept_between_texts(self):
+        md.convert(u'[a][1]\n\n[1]: http://example.com')
+        self.assertEqual(u'<p>[b][1]</p>', md.convert(u'[b][1]'))
+
+    def test_stashed_html_should_not_be_kept_between_texts(self):
+        for i in range(10):
+            md.convert(u'<div>%d</div>' % i)
+        self.assertEqual(1, md.instance.htmlStash.html_counter)
+
+    def test_concurrent_rendering_should_match_sequential_rendering(self):
+        inputs = [text % (i, i, i) for i in range(50) for text in self.texts]
+        sequential = create_markdown()
+        expected = [sequential.convert(text) for text in inputs]
+        failures = []
+
+        def run(offset):
+            try:
+                for _ in range(3):
+                    for i in range(len(inputs)):
+                        index = (i + offset) % len(inputs)
+                        if md.convert(inputs[index]) != expected[index]:
+                            failures.append(index)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=run, args=(n * 17,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], failures)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import schema
+import cPickle
 import caching
+from datetime import datetime
 import unittest2 as unittest
-from tests import AppEngineTestCase
+from tests import AppEngineTestCase, PatchingTestCase
 from models import SchemaDataIndex, PageOperationMixin, WikiPage
 
 
@@ -515,6 +517,114 @@ class TypeConversionTest(unittest.TestCase):
         self.assertEqual(u'CK', data['author'][1].value)
 
 
+class PrecheckTest(AppEngineTestCase):
+    def test_precheck_should_pass_whatever_constructor_accepts(self):
+        values = [
+            u'', u' ', u'.', u'abc', u'0', u'00', u'1', u'+1', u'- 1', u'\t-7\n', u'1L', u'0x10', u'1_0',
+            u'1,000', u'\u0661', u'1.0', u'1.5.', u'.5', u'5.', u'-.5', u'1e5', u'1.e5', u'.e5', u'5e',
+            u'1.5E-3', u'inf', u'-inf', u'Infinity', u'inf.', u'nan', u'+NaN', u'nan.0', u'1.inf',
+            u'yes', u'YES', u' yes', u'True', u'1999', u'-1999', u'1999-01-01', u'1999-??-??', u' 1999',
+            u'1999 BCE', u'9788937460883', u' 978-89-374-6088-3', u'isbn 9788937460883', u'89-374',
+            u'http://a.com', u' http://a.com', u'x http://a.com', u'https://www.youtube.com/watch?v=x',
+        ]
+        for type_obj, precheck in schema.PRECHECKS.items():
+            ptype = type_obj.__name__[:-len('Property')]
+            for value in values:
+                try:
+                    type_obj(u'Thing', ptype, u'name', value)
+                except ValueError:
+                    continue
+                self.assertTrue(precheck(value), u'%s %r' % (ptype, value))
+
+
+def _corpus(size):
+    pages = []
+    for i in range(size):
+        pages.append((u'Book', {
+            u'name': u'Book %d' % i,
+            u'author': [u'Author %d' % i, u'Author %d' % (i + 1)],
+            u'isbn': u'89%08d' % i,
+            u'datePublished': u'%d-05-??' % (1900 + i % 100),
+            u'numberOfPages': u'%d' % (100 + i),
+            u'url': u'http://example.com/books/%d' % i,
+            u'inLanguage': u'ko',
+            u'genre': u'Novel',
+        }))
+        pages.append((u'Person', {
+            u'name': u'Person %d' % i,
+            u'birthDate': u'%d BCE' % (300 + i),
+            u'jobTitle': u'Engineer',
+            u'url': [u'http://x.com/%d' % i, u'Homepage'],
+        }))
+        pages.append((u'SoftwareApplication', {
+            u'fileSize': u'%d.5' % i,
+            u'softwareVersion': u'1.%d' % i,
+        }))
+        pages.append((u'Article', {
+            u'isFamilyFriendly': u'yes' if i % 2 else u'No',
+            u'wordCount': u'%d' % (1000 + i),
+            u'image': u'http://x.com/%d.png' % i,
+        }))
+    return pages
+
+
+def _convert_uncompiled(itemtype, pname, pvalue):
+    """Conversion before per-property chains were compiled"""
+    if pname == 'schema':
+        return schema.TextProperty(itemtype, 'Text', pname, pvalue)
+
+    prop = schema.get_property(pname)
+    if 'enum' in prop and pvalue not in prop['enum']:
+        return schema.InvalidProperty(itemtype, 'Invalid', pname, pvalue)
+
+    types = [(schema.SchemaConverter.type_by_name(ptype), ptype) for ptype in prop['ranges']]
+    for type_obj, ptype in sorted(types, key=lambda t: schema.PRIORITY[t[0]]):
+        try:
+            return type_obj(itemtype, ptype, pname, pvalue)
+        except ValueError:
+            pass
+    return schema.InvalidProperty(itemtype, 'Invalid', pname, pvalue)
+
+
+class CompiledConverterTest(AppEngineTestCase):
+    def setUp(self):
+        super(CompiledConverterTest, self).setUp()
+        self.corpus = _corpus(25)
+
+    def test_same_result_as_uncompiled_conversion(self):
+        for itemtype, data in self.corpus:
+            converted = schema.SchemaConverter.convert(itemtype, data)
+            for pname, pvalue in data.items():
+                values = pvalue if type(pvalue) is list else [pvalue]
+                actuals = converted[pname] if type(pvalue) is list else [converted[pname]]
+                for value, actual in zip(values, actuals):
+                    expected = _convert_uncompiled(itemtype, pname, value)
+                    self.assertEqual(type(expected), type(actual))
+                    self.assertEqual(expected.render(), actual.render())
+
+    def test_common_values_convert_without_raising(self):
+        for itemtype, data in self.corpus:
+            schema.SchemaConverter.convert(itemtype, data)
+
+        constructed = []
+
+        def counting(type_obj):
+            def construct(*args):
+                constructed.append(type_obj)
+                return type_obj(*args)
+            return construct
+
+        for converter in schema.get_registry()._converters.values():
+            converter.chain = [(counting(t), ptype, precheck) for t, ptype, precheck in converter.chain]
+
+        valid = 0
+        for itemtype, data in self.corpus:
+            for value in schema.SchemaConverter.convert(itemtype, data).values():
+                values = value if type(value) is list else [value]
+                valid += len([v for v in values if not isinstance(v, schema.InvalidProperty)])
+        self.assertEqual(valid, len(constructed))
+
+
 class ConversionPriorityTest(unittest.TestCase):
     def test_try_url_first_then_text(self):
         prop = schema.SchemaConverter.convert(u'SoftwareApplication', {u'featureList': u'http://x.com'})['featureList']
@@ -563,6 +673,44 @@ class SchemaChangeTest(AppEngineTestCase):
         self.update_page(u'.schema Book\n\n    #!yaml/schema\n    author: "Alan Kang"\n\nHello there?\n', u'Hello')
 
 
+class SchemaRegistryTest(PatchingTestCase):
+    def setUp(self):
+        super(SchemaRegistryTest, self).setUp()
+        self.loaded = []
+        load_schema_file = schema._load_schema_file
+
+        def counting_loader(filename):
+            self.loaded.append(filename)
+            return load_schema_file(filename)
+        self.patch(schema, '_load_schema_file', counting_loader)
+
+        # force reload
+        self.patch(schema, 'SCHEMA_TO_LOAD', schema.SCHEMA_TO_LOAD + [{}])
+
+    def test_schema_files_should_be_parsed_at_most_once(self):
+        for _ in range(3):
+            # emulate new requests with cold memcache
+            caching.create_prc()
+            caching.flush_all()
+
+            schema.get_schema('Book')
+            schema.get_property('author')
+            schema.get_datatype('Boolean')
+            schema.get_itemtypes()
+            schema.SchemaConverter.convert(u'Book', {u'author': u'AK'})
+
+        self.assertEqual(['schema.json', 'schema.supplement.json', 'schema-custom.json'], self.loaded)
+
+    def test_should_reload_when_schema_to_load_changes(self):
+        schema.get_schema_set()
+        del self.loaded[:]
+
+        self.patch(schema, 'SCHEMA_TO_LOAD',
+                   schema.SCHEMA_TO_LOAD + [{'properties': {'author': {'cardinality': [1, 1]}}}])
+        self.assertEqual([1, 1], schema.get_schema_set()['properties']['author']['cardinality'])
+        self.assertEqual(3, len(self.loaded))
+
+
 class MiscTest(AppEngineTestCase):
     def setUp(self):
         super(MiscTest, self).setUp()
@@ -600,3 +748,51 @@ class MiscTest(AppEngineTestCase):
         self.assertEqual(dict, type(url))
         self.assertEqual([0, 0], url['cardinality'])
         self.assertEqual(['URL'], url['type']['ranges'])
+
+
+class CompactEncodingTest(AppEngineTestCase):
+    def setUp(self):
+        super(CompactEncodingTest, self).setUp()
+        self.data = schema.SchemaConverter.convert(u'Book', {
+            u'name': u'GEB',
+            u'author': [u'Douglas Hofstadter', u'Daniel Dennett'],
+            u'datePublished': u'1979-??-?? BCE',
+            u'isbn': u'0465026567',
+            u'numberOfPages': u'777',
+            u'unknownProp': u'Hello',
+        })
+        self.data['datePageModified'] = schema.DateTimeProperty(u'Article', 'DateTime', 'datePageModified', datetime(2013, 1, 2, 3, 4, 5))
+        self.data['raw'] = u'raw value'
+
+    def test_decoded_data_should_equal_original(self):
+        decoded = schema.decode_data(schema.encode_data(u'Book', self.data))
+        self.assertEqual(set(self.data.keys()), set(decoded.keys()))
+        for pname, value in self.data.items():
+            if isinstance(value, schema.InvalidProperty):
+                self.assertEqual((type(value), value.pvalue), (type(decoded[pname]), decoded[pname].pvalue))
+            else:
+                self.assertEqual(value, decoded[pname], pname)
+        self.assertEqual(u'Article', decoded['datePageModified'].itemtype)
+        self.assertEqual(1979, decoded['datePublished'].year)
+
+    def test_properties_should_be_rehydrated_on_access(self):
+        decoded = schema.decode_data(schema.encode_data(u'Book', self.data))
+        self.assertTrue('author' in decoded)
+        self.assertEqual(set(decoded.keys()), decoded._pending)
+
+        _ = decoded['name']
+        self.assertEqual(set(decoded.keys()) - {'name'}, decoded._pending)
+
+    def test_copy_should_be_plain_dict(self):
+        copied = schema.decode_data(schema.encode_data(u'Book', self.data)).copy()
+        self.assertEqual(dict, type(copied))
+        self.assertEqual(schema.TextProperty, type(copied['name']))
+
+    def test_data_cached_as_plain_dict_should_be_decoded(self):
+        self.assertIs(self.data, schema.decode_data(self.data))
+
+    def test_encoded_data_should_be_several_times_smaller(self):
+        data = schema.SchemaConverter.convert(u'Book', {u'name': u'Big Book', u'author': [u'Author %d' % i for i in range(300)]})
+        pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        encoded = cPickle.dumps(schema.encode_data(u'Book', data), cPickle.HIGHEST_PROTOCOL)
+        self.assertLess(len(encoded) * 3, len(pickled))
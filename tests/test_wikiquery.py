@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import caching
 from models import WikiPage
 import unittest2 as unittest
 from tests import AppEngineTestCase
@@ -141,3 +142,43 @@ class AclEvaluationTest(AppEngineTestCase):
     def test_user_with_permission(self):
         user = users.User('a@x.com')
         self.assertEqual([{u'name': u'A'}, {u'name': u'B'}], WikiPage.wikiquery(u'schema:"Book"', user))
+
+
+class CachedResultTest(AppEngineTestCase):
+    def setUp(self):
+        super(CachedResultTest, self).setUp()
+        self.login('ak@gmail.com', 'ak')
+        self.update_page(u'.schema Book\n[[author::Douglas Hofstadter]]', u'GEB')
+        self.update_page(u'.schema Person', u'Douglas Hofstadter')
+        self.query = u'schema:"Book" > name, author'
+        # title index is built once and then updated in place
+        WikiPage.get_titles()
+        self.assertEqual(u'Douglas Hofstadter', WikiPage.wikiquery(self.query)['author'].pvalue)
+
+    def assertCached(self, cached):
+        caching.create_prc()
+        self.assertEqual(cached, caching.get_wikiquery(self.query, 'None') is not None)
+
+    def test_unrelated_edit_should_not_invalidate_result(self):
+        self.update_page(u'.schema Person\nAuthor of GEB', u'Douglas Hofstadter')
+        self.assertCached(True)
+
+    def test_edit_of_page_in_result_should_invalidate_result(self):
+        self.update_page(u'.schema Book\n[[author::Daniel Dennett]]', u'GEB')
+        self.assertCached(False)
+        self.assertEqual(u'Daniel Dennett', WikiPage.wikiquery(self.query)['author'].pvalue)
+
+    def test_new_matching_page_should_invalidate_result(self):
+        self.update_page(u'.schema Book', u'The Mind\'s I')
+        self.assertCached(False)
+        self.assertEqual(2, len(WikiPage.wikiquery(self.query)))
+
+    def test_page_leaving_result_should_invalidate_result(self):
+        self.update_page(u'.schema Person', u'GEB')
+        self.assertCached(False)
+        self.assertEqual([], WikiPage.wikiquery(self.query))
+
+    def test_acl_change_should_invalidate_result(self):
+        self.update_page(u'.schema Book\n.read ak@gmail.com\n[[author::Douglas Hofstadter]]', u'GEB')
+        self.assertCached(False)
+        self.assertEqual([], WikiPage.wikiquery(self.query))
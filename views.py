@@ -136,5 +136,13 @@ class SpecialPageHandler(webapp2.RequestHandler):
             deferred.defer(WikiPage.rebuild_all_data_index, 0)
             self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
             self.response.write('Done! (queued)')
+        elif path == u'reconcile_titles':
+            WikiPage.reconcile_title_index()
+            self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+            self.response.write('Done!')
+        elif path == u'migrate_page_keys':
+            deferred.defer(WikiPage.migrate_all_to_title_keys)
+            self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+            self.response.write('Done! (queued)')
         else:
             self.abort(404)